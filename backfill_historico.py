@@ -0,0 +1,166 @@
+"""
+Backfill histórico por rangos de fecha
+======================================
+
+Reconstruye BigQuery y/o el Google Sheet sin intervención manual, partiendo
+el historial en rangos de `_submission_time` (shards).
+
+- Descarga, clasificación y formato de cada shard corren en paralelo en un
+  pool de procesos acotado (--paralelo).
+- La carga se hace shard por shard, en orden cronológico, a medida que cada
+  uno termina: upsert por _uuid en Sheets y MERGE por uuid en BigQuery, así
+  volver a cargar un shard no duplica filas.
+- Cada etapa de cada shard queda con checkpoint (ver etapas.py): si el
+  backfill se corta, al reejecutarlo con los mismos parámetros retoma desde
+  los shards pendientes. Sin --hasta, la fecha final (mañana) se resuelve la
+  primera vez y queda guardada en la corrida: reejecutar después de
+  medianoche retoma la misma corrida con el mismo rango.
+
+Uso:
+    python backfill_historico.py --desde 2024-01-01 [--hasta 2025-01-01]
+        [--dias-por-shard 30] [--paralelo 4] [--destino ambos|sheets|bigquery]
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+
+import clasificacion_paralela
+import main_act_flash as etl
+from etapas import iniciar_corrida, ejecutar_etapa, finalizar_corrida
+from sincronizacion import cargar_indice, consultar_kobo
+
+
+def generar_shards(desde, hasta, dias):
+    """Rangos [inicio, fin) de `dias` días entre desde y hasta."""
+    shards = []
+    inicio = desde
+    while inicio < hasta:
+        fin = min(inicio + timedelta(days=dias), hasta)
+        shards.append((inicio.strftime('%Y-%m-%dT00:00:00'), fin.strftime('%Y-%m-%dT00:00:00')))
+        inicio = fin
+    return shards
+
+
+def _inicializar_worker():
+    # Cada shard ya corre en su propio proceso: la clasificación dentro del shard es serial
+    clasificacion_paralela.PROCESOS_CLASIFICACION = 1
+
+
+def procesar_shard(corrida, desde, hasta):
+    """
+    Extracción, clasificación y formato de un shard (corre en un proceso del pool).
+    Devuelve (df_final o None, filas descargadas, segundos).
+    """
+    inicio = time.time()
+    shard = desde[:10]
+    headers = {"Authorization": f"Token {etl.TOKEN_KOBO}"}
+
+    df_raw = ejecutar_etapa(corrida, f"extraccion_{shard}", lambda: consultar_kobo(etl.URL_KOBO, headers, rango=(desde, hasta)))
+    if df_raw.empty:
+        return None, 0, time.time() - inicio
+
+    df_procesado = ejecutar_etapa(corrida, f"clasificacion_{shard}", lambda: etl.clasificar_envios(df_raw))
+    if df_procesado is None or df_procesado.empty:
+        return None, len(df_raw), time.time() - inicio
+
+    df_final = ejecutar_etapa(corrida, f"formato_{shard}", lambda: etl.formatear_salida(df_procesado))
+    return df_final, len(df_raw), time.time() - inicio
+
+
+def cargar_shard(corrida, shard, df_final, destino):
+    """Carga idempotente de un shard en los destinos elegidos."""
+    if destino in ('ambos', 'sheets'):
+        # La marca de agua del proceso horario no se mueve durante el backfill
+        watermark = cargar_indice()['watermark']
+        ejecutar_etapa(
+            corrida, f"carga_sheets_{shard}",
+            lambda: etl.cargar_en_sheets(df_final, cargar_indice(), watermark)
+        )
+
+    if destino in ('ambos', 'bigquery'):
+        # Shard completo (no sólo lo escrito en Sheets): el Sheet puede estar al día
+        # mientras BigQuery se reconstruye; el MERGE por uuid lo hace idempotente
+        ejecutar_etapa(
+            corrida, f"carga_bigquery_{shard}",
+            lambda: etl.subir_a_bigquery(df_final, modo='upsert', id_corrida=f"{corrida['id']}_{shard.replace('-', '')}")
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill histórico de Kobo por rangos de _submission_time")
+    parser.add_argument('--desde', required=True, help="Fecha inicial (YYYY-MM-DD), inclusive")
+    parser.add_argument('--hasta', help="Fecha final (YYYY-MM-DD), exclusiva. Por defecto, mañana (fijada al iniciar la corrida)")
+    parser.add_argument('--dias-por-shard', type=int, default=30)
+    parser.add_argument('--paralelo', type=int, default=max(1, min(4, os.cpu_count() or 1)))
+    parser.add_argument('--destino', choices=['ambos', 'sheets', 'bigquery'], default='ambos')
+    args = parser.parse_args()
+
+    # Mismos parámetros → misma corrida: un backfill cortado se retoma sin
+    # límite de antigüedad (cada shard se carga con upsert/MERGE por uuid).
+    # La clave usa los argumentos dados, no la fecha final por defecto
+    corrida = iniciar_corrida(
+        f"backfill_{args.desde}_{args.hasta or 'abierto'}_{args.dias_por_shard}_{args.destino}", vigencia_min=None
+    )
+    # La fecha final resuelta queda con checkpoint: al retomar se usa la misma
+    fecha_hasta = ejecutar_etapa(corrida, 'rango', lambda: args.hasta or (date.today() + timedelta(days=1)).isoformat())
+
+    desde = datetime.strptime(args.desde, '%Y-%m-%d')
+    hasta = datetime.strptime(fecha_hasta, '%Y-%m-%d')
+    shards = generar_shards(desde, hasta, args.dias_por_shard)
+    if not shards:
+        print("❌ Rango de fechas vacío")
+        finalizar_corrida(corrida)
+        sys.exit(1)
+
+    print("="*60)
+    print("📦 BACKFILL HISTÓRICO")
+    print("="*60)
+    print(f"   • Rango: {args.desde} → {fecha_hasta} ({len(shards)} shards de {args.dias_por_shard} días)")
+    print(f"   • Procesos en paralelo: {args.paralelo}")
+    print(f"   • Destino: {args.destino}")
+
+    inicio_total = time.time()
+    filas_total = 0
+    shards_con_error = []
+
+    with ProcessPoolExecutor(max_workers=args.paralelo, initializer=_inicializar_worker) as pool:
+        futuros = [(desde_shard, pool.submit(procesar_shard, corrida, desde_shard, hasta_shard))
+                   for desde_shard, hasta_shard in shards]
+
+        # Se carga en orden cronológico mientras los shards siguientes se siguen procesando
+        for nro, (desde_shard, futuro) in enumerate(futuros, start=1):
+            shard = desde_shard[:10]
+            try:
+                df_final, filas, segundos = futuro.result()
+                if df_final is not None:
+                    cargar_shard(corrida, shard, df_final, args.destino)
+            except Exception as e:
+                print(f"   ❌ Shard {shard}: {e}")
+                shards_con_error.append(shard)
+                continue
+
+            filas_total += filas
+            transcurrido = time.time() - inicio_total
+            restante = transcurrido / nro * (len(shards) - nro)
+            print(f"   ✅ [{nro}/{len(shards)}] Shard {shard}: {filas} envíos en {segundos:.1f}s | "
+                  f"total {filas_total} envíos, {filas_total / max(transcurrido, 1e-9):.1f} envíos/s | "
+                  f"restante ~{restante / 60:.1f} min")
+
+    print("\n" + "="*60)
+    if shards_con_error:
+        print(f"⚠️ BACKFILL INCOMPLETO: {len(shards_con_error)} shards con error ({', '.join(shards_con_error)})")
+        print(f"   Reejecutar con los mismos parámetros retoma la corrida {corrida['id']}")
+        print("="*60)
+        sys.exit(1)
+
+    finalizar_corrida(corrida)
+    print(f"✅ BACKFILL COMPLETADO: {filas_total} envíos en {(time.time() - inicio_total) / 60:.1f} min")
+    print("="*60)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Modo de baja memoria
+====================
+
+Representación compacta de los DataFrames para historiales grandes:
+- Columnas de baja cardinalidad (Turno, username, deviceid, _status,
+  Poligono, Localizacion, ...) como `category` (codificación por diccionario).
+- Conteos enteros con el dtype entero más chico posible. Los float
+  (coordenadas, altitud, precisión) quedan en float64: en float32 se
+  escribirían valores como 25.700000762939453 y cambiaría el hash de cada
+  fila al activar o desactivar el modo.
+
+La expansión a objetos Python (None, str, int, float) se hace recién al
+serializar cada lote para el destino (Google Sheets / BigQuery), en lugar de
+convertir todo el DataFrame con `astype(object)` de una sola vez.
+
+Se activa con la variable de entorno KOBO_BAJA_MEMORIA=1.
+"""
+
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+BAJA_MEMORIA = os.environ.get("KOBO_BAJA_MEMORIA", "").lower() in ('1', 'true', 'si', 'sí')
+TAMANO_LOTE = int(os.environ.get("KOBO_TAMANO_LOTE", "5000"))
+
+COLUMNAS_CATEGORICAS = [
+    'Turno', 'username', 'deviceid', '_status', '_submitted_by', '__version__',
+    'Poligono', 'Localizacion', 'version_geometria'
+]
+
+COLUMNAS_ENTERAS = ['Cantidad de personas en situación de calle observadas', 'datos_per/cant_pers', '_id', '_index']
+
+
+def compactar(df):
+    """Convierte en el lugar las columnas conocidas a dtypes compactos."""
+    for col in COLUMNAS_CATEGORICAS:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            try:
+                df[col] = df[col].astype('category')
+            except TypeError:
+                pass  # Valores no hasheables (listas/diccionarios): se deja como está
+
+    for col in COLUMNAS_ENTERAS:
+        if col in df.columns:
+            valores = pd.to_numeric(df[col], errors='coerce')
+            if valores.notna().all():
+                df[col] = pd.to_numeric(valores, downcast='integer')
+
+    return df
+
+
+def _a_python(valor):
+    """Valor listo para JSON: None para NaN/inf, str para listas/diccionarios."""
+    if valor is None:
+        return None
+    if isinstance(valor, (list, dict)):
+        return str(valor)
+    if isinstance(valor, np.generic):
+        valor = valor.item()
+    if isinstance(valor, float) and (math.isnan(valor) or math.isinf(valor)):
+        return None
+    if valor is pd.NaT or valor is pd.NA:
+        return None
+    return valor
+
+
+def serializar_lote(lote):
+    """Expande un lote (DataFrame) a lista de filas con objetos Python."""
+    columnas = [lote[col].astype(object).tolist() for col in lote.columns]
+    return [[_a_python(v) for v in fila] for fila in zip(*columnas)]
+
+
+def iterar_lotes(df, tamano=None):
+    """Genera (inicio, lote DataFrame) recorriendo df en bloques de `tamano` filas."""
+    tamano = tamano or TAMANO_LOTE
+    for inicio in range(0, len(df), tamano):
+        yield inicio, df.iloc[inicio:inicio + tamano]
+
+
+def lote_como_objetos(lote):
+    """Lote expandido a DataFrame de objetos Python (para to_gbq)."""
+    return pd.DataFrame(serializar_lote(lote), columns=lote.columns, index=lote.index)
+
+
+def escribir_en_sheet(sheet, df, reemplazar=False, tamano=None):
+    """
+    Escribe df en el worksheet serializando lote por lote.
+    Con reemplazar=True limpia la hoja y escribe el encabezado primero.
+    """
+    if reemplazar:
+        sheet.clear()
+        sheet.update(values=[[str(c) for c in df.columns]], value_input_option='USER_ENTERED')
+
+    for inicio, lote in iterar_lotes(df, tamano):
+        sheet.append_rows(values=serializar_lote(lote), value_input_option='USER_ENTERED')
+        print(f"   ⬆️ Filas {inicio + 1}-{inicio + len(lote)} de {len(df)} subidas")
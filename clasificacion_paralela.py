@@ -0,0 +1,170 @@
+"""
+Clasificación espacial en paralelo
+==================================
+
+Modo para reclasificaciones de todo el historial y backfills grandes:
+reparte los puntos entre procesos agrupándolos por tesela espacial y aplica
+la misma lógica que `clasificar_localizacion` + `asignar_recorrido`
+(Palermo Norte → Anillo Digital C2 → Comunas, y polígono de Recorrido).
+
+Las geometrías compiladas (WKB), las coordenadas y los arreglos de salida
+viven en memoria compartida (`multiprocessing.shared_memory`): cada worker
+los abre por nombre en lugar de recibir una copia serializada por tarea.
+Cada worker escribe sus resultados en la posición original de cada punto,
+por lo que el resultado queda en el orden de las filas de entrada.
+
+Se activa con KOBO_PROCESOS_CLASIFICACION=N (N > 1) cuando hay al menos
+MINIMO_PUNTOS_PARALELO puntos.
+"""
+
+import os
+import pickle
+from multiprocessing import Pool, shared_memory
+
+import numpy as np
+import pandas as pd
+import shapely
+
+PROCESOS_CLASIFICACION = int(os.environ.get("KOBO_PROCESOS_CLASIFICACION", "1"))
+MINIMO_PUNTOS_PARALELO = 20000
+TAMANO_TESELA = 0.01  # grados (~1 km en CABA)
+TAREAS_POR_PROCESO = 4
+
+# Orden de los pasos de clasificación (capa de compilar_capas)
+PASOS_LOCALIZACION = ['palermo_norte', 'anillo_digital', 'comunas']
+
+# Memoria compartida abierta en cada worker (se inicializa una vez por proceso)
+_worker = {}
+
+
+def usar_modo_paralelo(cantidad_puntos):
+    return PROCESOS_CLASIFICACION > 1 and cantidad_puntos >= MINIMO_PUNTOS_PARALELO
+
+
+def _crear_memoria(nbytes):
+    return shared_memory.SharedMemory(create=True, size=max(int(nbytes), 1))
+
+
+def _inicializar_worker(nombre_geom, tam_geom, nombre_coords, nombre_orden, nombre_loc, nombre_pol, n):
+    bloques = {
+        'geom': shared_memory.SharedMemory(name=nombre_geom),
+        'coords': shared_memory.SharedMemory(name=nombre_coords),
+        'orden': shared_memory.SharedMemory(name=nombre_orden),
+        'loc': shared_memory.SharedMemory(name=nombre_loc),
+        'pol': shared_memory.SharedMemory(name=nombre_pol),
+    }
+    capas_wkb = pickle.loads(bytes(bloques['geom'].buf[:tam_geom]))
+
+    capas = {}
+    for capa, valores in capas_wkb.items():
+        geometrias = [(valor, shapely.from_wkb(wkb)) for valor, wkb in valores]
+        for _, geom in geometrias:
+            shapely.prepare(geom)
+        capas[capa] = geometrias
+
+    _worker.update({
+        'bloques': bloques,
+        'capas': capas,
+        'coords': np.ndarray((2, n), dtype=np.float64, buffer=bloques['coords'].buf),
+        'orden': np.ndarray((n,), dtype=np.int64, buffer=bloques['orden'].buf),
+        'loc': np.ndarray((n,), dtype=np.float64, buffer=bloques['loc'].buf),
+        'pol': np.ndarray((n,), dtype=np.int16, buffer=bloques['pol'].buf),
+    })
+
+
+def _clasificar_rango(rango):
+    inicio, fin = rango
+    idx = _worker['orden'][inicio:fin]
+    x = _worker['coords'][0, idx]
+    y = _worker['coords'][1, idx]
+    capas = _worker['capas']
+
+    # Localizacion: cada paso sólo mira los puntos todavía sin clasificar
+    loc = np.full(len(idx), np.nan)
+    for capa in PASOS_LOCALIZACION:
+        for valor, geom in capas.get(capa, []):
+            pendientes = np.flatnonzero(np.isnan(loc))
+            if len(pendientes) == 0:
+                break
+            dentro = shapely.contains_xy(geom, x[pendientes], y[pendientes])
+            loc[pendientes[dentro]] = float(valor)
+
+    # Poligono: como en asignar_recorrido, el último recorrido que contiene al punto gana
+    pol = np.full(len(idx), -1, dtype=np.int16)
+    for codigo, (_, geom) in enumerate(capas.get('recorridos', [])):
+        pol[shapely.contains_xy(geom, x, y)] = codigo
+
+    _worker['loc'][idx] = loc
+    _worker['pol'][idx] = pol
+    return fin - inicio
+
+
+def _rangos_por_tesela(longitudes, latitudes, cantidad_tareas):
+    """Orden de los puntos agrupados por tesela y cortes en bloques de tamaño parejo."""
+    tesela_x = np.floor(longitudes / TAMANO_TESELA)
+    tesela_y = np.floor(latitudes / TAMANO_TESELA)
+    orden = np.lexsort((latitudes, tesela_y, tesela_x)).astype(np.int64)
+    cortes = np.linspace(0, len(orden), cantidad_tareas + 1).astype(int)
+    rangos = [(int(a), int(b)) for a, b in zip(cortes[:-1], cortes[1:]) if b > a]
+    return orden, rangos
+
+
+def clasificar_en_paralelo(longitudes, latitudes, capas, procesos=None):
+    """
+    Clasifica los puntos con un pool de procesos.
+    `capas` es el resultado de geometrias.compilar_capas.
+    Devuelve (Localizacion, Poligono) como Series alineadas con `longitudes`.
+    """
+    procesos = procesos or PROCESOS_CLASIFICACION
+    indice = longitudes.index
+    lon = np.ascontiguousarray(longitudes.to_numpy(dtype=np.float64))
+    lat = np.ascontiguousarray(latitudes.to_numpy(dtype=np.float64))
+    n = len(lon)
+
+    nombres_recorrido = list(capas.get('recorridos', {}))
+    capas_wkb = pickle.dumps({
+        capa: [(valor, shapely.to_wkb(geom)) for valor, geom in valores.items()]
+        for capa, valores in capas.items()
+    })
+    orden, rangos = _rangos_por_tesela(lon, lat, procesos * TAREAS_POR_PROCESO)
+
+    print(f"   ⚙️ Clasificación paralela: {n} puntos, {procesos} procesos, {len(rangos)} bloques por tesela")
+
+    bloques = []
+    coords = None
+    try:
+        shm_geom = _crear_memoria(len(capas_wkb))
+        shm_coords = _crear_memoria(2 * n * 8)
+        shm_orden = _crear_memoria(n * 8)
+        shm_loc = _crear_memoria(n * 8)
+        shm_pol = _crear_memoria(n * 2)
+        bloques = [shm_geom, shm_coords, shm_orden, shm_loc, shm_pol]
+
+        shm_geom.buf[:len(capas_wkb)] = capas_wkb
+        coords = np.ndarray((2, n), dtype=np.float64, buffer=shm_coords.buf)
+        coords[0], coords[1] = lon, lat
+        np.ndarray((n,), dtype=np.int64, buffer=shm_orden.buf)[:] = orden
+
+        with Pool(
+            processes=procesos,
+            initializer=_inicializar_worker,
+            initargs=(shm_geom.name, len(capas_wkb), shm_coords.name, shm_orden.name, shm_loc.name, shm_pol.name, n)
+        ) as pool:
+            procesados = 0
+            for cantidad in pool.imap_unordered(_clasificar_rango, rangos):
+                procesados += cantidad
+
+        loc = np.ndarray((n,), dtype=np.float64, buffer=shm_loc.buf).copy()
+        codigos = np.ndarray((n,), dtype=np.int16, buffer=shm_pol.buf).copy()
+    finally:
+        coords = None  # liberar la vista antes de cerrar la memoria compartida
+        for shm in bloques:
+            shm.close()
+            shm.unlink()
+
+    localizacion = pd.Series(loc, index=indice)
+    nombres = np.array([''] + nombres_recorrido, dtype=object)
+    poligono = pd.Series(nombres[codigos + 1], index=indice, dtype=object)
+
+    print(f"   ✅ {procesados} puntos clasificados en paralelo")
+    return localizacion, poligono
@@ -0,0 +1,167 @@
+"""
+Etapas con checkpoint
+=====================
+
+Cada etapa del proceso (extracción, clasificación, formato, carga a Sheets,
+carga a BigQuery) guarda su resultado como un artefacto direccionado por
+contenido (`artefactos/<sha256>.pkl`) y un marcador de finalización
+(`corridas/<script>/<id_corrida>/<etapa>.json`).
+
+Si una corrida falla, la siguiente ejecución del mismo script retoma la
+corrida pendiente: las etapas terminadas se cargan desde su artefacto y sólo
+se vuelven a ejecutar las que faltan. Los destinos usan el id de corrida para
+confirmar la carga una sola vez.
+
+Tras KOBO_MAX_REINTENTOS intentos fallidos (3 por defecto), o si la corrida
+pendiente tiene más de KOBO_VIGENCIA_CORRIDA_MIN minutos (120 por defecto),
+se abandona y se empieza una nueva: una extracción vieja no debe pisar datos
+que se cargaron después.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import uuid
+from datetime import datetime
+
+from sincronizacion import ESTADO_DIR
+
+DIR_ARTEFACTOS = os.path.join(ESTADO_DIR, 'artefactos')
+DIR_CORRIDAS = os.path.join(ESTADO_DIR, 'corridas')
+MAX_REINTENTOS = int(os.environ.get("KOBO_MAX_REINTENTOS", "3"))
+VIGENCIA_CORRIDA_MIN = int(os.environ.get("KOBO_VIGENCIA_CORRIDA_MIN", "120"))
+
+
+def _escribir_json(ruta, contenido):
+    tmp = ruta + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(contenido, f)
+    os.replace(tmp, ruta)
+
+
+def _antiguedad_min(id_corrida):
+    """Minutos desde el inicio de la corrida (el id empieza con AAAAMMDD_HHMMSS)."""
+    try:
+        inicio = datetime.strptime(id_corrida[:15], '%Y%m%d_%H%M%S')
+    except ValueError:
+        return float('inf')
+    return (datetime.now() - inicio).total_seconds() / 60
+
+
+def iniciar_corrida(script, vigencia_min=VIGENCIA_CORRIDA_MIN):
+    """
+    Devuelve la corrida a ejecutar: la pendiente del script (si la hay, no
+    superó el máximo de reintentos y sigue vigente) o una nueva.
+    vigencia_min=None la retoma sin importar su antigüedad (cargas idempotentes).
+    """
+    dir_script = os.path.join(DIR_CORRIDAS, script)
+    ruta_actual = os.path.join(dir_script, 'actual.json')
+    os.makedirs(dir_script, exist_ok=True)
+
+    if os.path.exists(ruta_actual):
+        with open(ruta_actual, 'r', encoding='utf-8') as f:
+            actual = json.load(f)
+        antiguedad = _antiguedad_min(actual['id'])
+        vencida = vigencia_min is not None and antiguedad > vigencia_min
+        if actual['intentos'] < MAX_REINTENTOS and not vencida:
+            actual['intentos'] += 1
+            _escribir_json(ruta_actual, actual)
+            print(f"♻️ Retomando corrida {actual['id']} (intento {actual['intentos']})")
+            return {'script': script, 'id': actual['id'], 'dir': os.path.join(dir_script, actual['id'])}
+        if vencida:
+            print(f"⚠️ Corrida {actual['id']} abandonada: tiene {antiguedad:.0f} min (máximo {vigencia_min})")
+        else:
+            print(f"⚠️ Corrida {actual['id']} abandonada tras {actual['intentos']} intentos")
+        _descartar(dir_script, actual['id'])
+
+    id_corrida = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+    os.makedirs(os.path.join(dir_script, id_corrida), exist_ok=True)
+    _escribir_json(ruta_actual, {'id': id_corrida, 'intentos': 1})
+    print(f"🆔 Corrida {id_corrida}")
+    return {'script': script, 'id': id_corrida, 'dir': os.path.join(dir_script, id_corrida)}
+
+
+def guardar_artefacto(objeto):
+    """Serializa el objeto y lo guarda por su hash. Devuelve el hash."""
+    datos = pickle.dumps(objeto, protocol=pickle.HIGHEST_PROTOCOL)
+    digest = hashlib.sha256(datos).hexdigest()
+    ruta = os.path.join(DIR_ARTEFACTOS, f"{digest}.pkl")
+    if not os.path.exists(ruta):
+        os.makedirs(DIR_ARTEFACTOS, exist_ok=True)
+        # Temporal propio del proceso: shards en paralelo pueden producir el mismo artefacto
+        tmp = f"{ruta}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(datos)
+        os.replace(tmp, ruta)
+    return digest
+
+
+def cargar_artefacto(digest):
+    ruta = os.path.join(DIR_ARTEFACTOS, f"{digest}.pkl")
+    if not os.path.exists(ruta):
+        return None, False
+    with open(ruta, 'rb') as f:
+        return pickle.load(f), True
+
+
+def ejecutar_etapa(corrida, etapa, funcion):
+    """
+    Ejecuta `funcion()` salvo que la etapa ya esté completa en esta corrida,
+    en cuyo caso devuelve el resultado guardado.
+    """
+    ruta_marcador = os.path.join(corrida['dir'], f"{etapa}.json")
+    if os.path.exists(ruta_marcador):
+        with open(ruta_marcador, 'r', encoding='utf-8') as f:
+            marcador = json.load(f)
+        resultado, encontrado = cargar_artefacto(marcador['artefacto'])
+        if encontrado:
+            print(f"   ⏭️ Etapa '{etapa}' ya completada en {marcador['completada']}: se reutiliza")
+            return resultado
+        print(f"   ⚠️ Falta el artefacto de la etapa '{etapa}': se vuelve a ejecutar")
+
+    resultado = funcion()
+    _escribir_json(ruta_marcador, {
+        'artefacto': guardar_artefacto(resultado),
+        'completada': datetime.now().isoformat(timespec='seconds')
+    })
+    return resultado
+
+
+def _artefactos_de(dir_corrida):
+    digests = set()
+    if os.path.isdir(dir_corrida):
+        for nombre in os.listdir(dir_corrida):
+            if nombre.endswith('.json'):
+                with open(os.path.join(dir_corrida, nombre), 'r', encoding='utf-8') as f:
+                    digests.add(json.load(f)['artefacto'])
+    return digests
+
+
+def _descartar(dir_script, id_corrida):
+    """Borra la corrida y los artefactos que ninguna otra corrida usa."""
+    dir_corrida = os.path.join(dir_script, id_corrida)
+    propios = _artefactos_de(dir_corrida)
+    shutil.rmtree(dir_corrida, ignore_errors=True)
+
+    en_uso = set()
+    for script in os.listdir(DIR_CORRIDAS):
+        dir_otro = os.path.join(DIR_CORRIDAS, script)
+        if os.path.isdir(dir_otro):
+            for otra in os.listdir(dir_otro):
+                en_uso |= _artefactos_de(os.path.join(dir_otro, otra))
+    for digest in propios - en_uso:
+        ruta = os.path.join(DIR_ARTEFACTOS, f"{digest}.pkl")
+        if os.path.exists(ruta):
+            os.remove(ruta)
+
+    ruta_actual = os.path.join(dir_script, 'actual.json')
+    if os.path.exists(ruta_actual):
+        os.remove(ruta_actual)
+
+
+def finalizar_corrida(corrida):
+    """Marca la corrida como terminada y libera sus artefactos."""
+    _descartar(os.path.join(DIR_CORRIDAS, corrida['script']), corrida['id'])
+    print(f"🏁 Corrida {corrida['id']} finalizada")
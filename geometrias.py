@@ -0,0 +1,188 @@
+"""
+Capas geográficas y versionado de geometrías
+============================================
+
+Centraliza la carga de las capas usadas en la clasificación espacial
+(Palermo Norte, Anillo Digital C2, Comunas y polígonos de Recorrido) y
+calcula un hash de versión a partir de las geometrías ya compiladas.
+
+Cada fila de salida se marca con ese hash (columna `version_geometria`),
+con el prefijo `g` (ej. `g3bf0d64f7685`): las filas se escriben con
+USER_ENTERED y Sheets convertiría un hash hexadecimal que parece número
+(`012345678901` pierde el 0, `12345e678901` pasa a notación científica).
+Cuando una capa cambia, se guarda una instantánea de la versión en
+`versiones_geometria/<hash>.json` y la reclasificación compara la versión
+vieja con la nueva: sólo se vuelven a clasificar los puntos que caen dentro
+de la diferencia simétrica entre ambas geometrías.
+
+Las instantáneas deben commitearse junto con el cambio de capa para que la
+reclasificación pueda calcular el área afectada.
+"""
+
+import hashlib
+import json
+import os
+import zipfile
+
+import geopandas as gpd
+import pandas as pd
+from shapely import wkt
+from shapely.geometry import Polygon
+from shapely.ops import unary_union
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Prefijo no numérico de la versión (ver docstring del módulo)
+PREFIJO_VERSION = 'g'
+DIR_VERSIONES_GEOMETRIA = os.path.join(BASE_DIR, 'versiones_geometria')
+
+COLUMNA_VERSION = 'version_geometria'
+
+# Valores de Localizacion asignados por capa
+VALOR_PALERMO_NORTE = 14.5
+VALOR_ANILLO_DIGITAL = 2.5
+
+POLIGONOS_RECORRIDO = {
+    'Recorrido A': Polygon([(-58.41017, -34.588232), (-58.413901, -34.594177), (-58.413904, -34.599714),(-58.400064, -34.600033), (-58.386224, -34.599855), (-58.398154, -34.59498),(-58.404592, -34.593108), (-58.386524, -34.595263), (-58.41017, -34.588232)]),
+    'Recorrido B': Polygon([(-58.389185, -34.584593), (-58.395365, -34.587137), (-58.400944, -34.594168),(-58.398154, -34.59498), (-58.386524, -34.595263), (-58.383284, -34.587544),(-58.388112, -34.59256), (-58.389185, -34.584593)]),
+    'Recorrido C': Polygon([(-58.400944, -34.594168), (-58.395365, -34.587137), (-58.389185, -34.584593),(-58.398455, -34.580212), (-58.407295, -34.581837), (-58.404592, -34.593108),(-58.41017, -34.588232), (-58.400944, -34.594168)])
+}
+
+POSIBLES_COLUMNAS_COMUNA = ['comunas', 'COMUNAS', 'comuna', 'COMUNA', 'NAM', 'ID', 'OBJETO', 'barrio']
+
+
+def buscar_columna_comuna(columnas):
+    """Devuelve la primera columna que identifica la comuna, o None."""
+    for col in POSIBLES_COLUMNAS_COMUNA:
+        if col in columnas:
+            return col
+    return None
+
+
+def leer_kmz(ruta):
+    """Lee el primer KML contenido en un KMZ y lo devuelve en EPSG:4326."""
+    with zipfile.ZipFile(ruta, 'r') as kmz:
+        kml_files = [f for f in kmz.namelist() if f.endswith('.kml')]
+        if not kml_files:
+            raise FileNotFoundError(f"No se encontró KML dentro de {os.path.basename(ruta)}")
+        with kmz.open(kml_files[0]) as kml_file:
+            gdf = gpd.read_file(kml_file)
+    if gdf.crs is None:
+        gdf.set_crs("EPSG:4326", inplace=True)
+    return gdf.to_crs("EPSG:4326")
+
+
+def cargar_capas(ruta_palermo, ruta_anillo_digital, ruta_comunas):
+    """
+    Carga las tres capas de clasificación.
+    Devuelve (palermo_gdf, anillo_digital_gdf, comunas_gdf) en EPSG:4326.
+    """
+    print("📂 Cargando archivo Palermo Norte...")
+    palermo_gdf = leer_kmz(ruta_palermo)
+
+    print("📂 Cargando archivo Anillo Digital C2...")
+    anillo_digital_gdf = leer_kmz(ruta_anillo_digital)
+
+    print("📂 Cargando shapefile de comunas...")
+    comunas_gdf = gpd.read_file(ruta_comunas).to_crs("EPSG:4326")
+
+    return palermo_gdf, anillo_digital_gdf, comunas_gdf
+
+
+def compilar_capas(palermo_gdf, anillo_digital_gdf, comunas_gdf, poligonos_recorrido=None):
+    """
+    Reduce las capas a {capa: {valor: geometria}}, uniendo las geometrías
+    que producen el mismo valor de salida. Es la forma canónica que se
+    usa para calcular el hash de versión y las diferencias entre versiones.
+    """
+    if poligonos_recorrido is None:
+        poligonos_recorrido = POLIGONOS_RECORRIDO
+
+    capas = {
+        'palermo_norte': {str(VALOR_PALERMO_NORTE): unary_union(list(palermo_gdf.geometry))},
+        'anillo_digital': {str(VALOR_ANILLO_DIGITAL): unary_union(list(anillo_digital_gdf.geometry))},
+        'comunas': {},
+        'recorridos': {nombre: poligono for nombre, poligono in poligonos_recorrido.items()},
+    }
+
+    comuna_col = buscar_columna_comuna(comunas_gdf.columns)
+    if comuna_col:
+        valores = pd.to_numeric(comunas_gdf[comuna_col], errors='coerce')
+        for valor, geometrias in comunas_gdf.geometry.groupby(valores):
+            capas['comunas'][str(float(valor))] = unary_union(list(geometrias))
+
+    return capas
+
+
+def hash_version(capas):
+    """Hash corto y estable de las geometrías compiladas (independiente del orden), con PREFIJO_VERSION."""
+    h = hashlib.sha256()
+    for capa in sorted(capas):
+        h.update(capa.encode('utf-8'))
+        for valor in sorted(capas[capa]):
+            h.update(valor.encode('utf-8'))
+            h.update(capas[capa][valor].normalize().wkb)
+    return PREFIJO_VERSION + h.hexdigest()[:12]
+
+
+def guardar_instantanea(capas, version=None):
+    """Guarda la versión en versiones_geometria/<hash>.json si todavía no existe."""
+    version = version or hash_version(capas)
+    ruta = os.path.join(DIR_VERSIONES_GEOMETRIA, f"{version}.json")
+    if not os.path.exists(ruta):
+        os.makedirs(DIR_VERSIONES_GEOMETRIA, exist_ok=True)
+        contenido = {
+            capa: {valor: geom.wkt for valor, geom in valores.items()}
+            for capa, valores in capas.items()
+        }
+        # Escritura atómica: varios procesos (ej. shards de un backfill) pueden guardarla a la vez
+        tmp = f"{ruta}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(contenido, f)
+        os.replace(tmp, ruta)
+        print(f"   💾 Nueva versión de geometrías guardada: {version}")
+    return version
+
+
+def cargar_instantanea(version):
+    """
+    Carga una versión guardada. Devuelve None si no hay instantánea.
+    Las filas marcadas antes del prefijo (hash sin `g`) usan la misma instantánea.
+    """
+    version = str(version)
+    if not version.startswith(PREFIJO_VERSION):
+        version = PREFIJO_VERSION + version
+    ruta = os.path.join(DIR_VERSIONES_GEOMETRIA, f"{version}.json")
+    if not os.path.exists(ruta):
+        return None
+    with open(ruta, 'r', encoding='utf-8') as f:
+        contenido = json.load(f)
+    return {
+        capa: {valor: wkt.loads(geom) for valor, geom in valores.items()}
+        for capa, valores in contenido.items()
+    }
+
+
+def area_afectada(capas_viejas, capas_nuevas):
+    """
+    Unión de las diferencias simétricas, valor por valor, entre dos versiones.
+    Un punto fuera de esta área pertenece exactamente a los mismos polígonos en
+    ambas versiones, por lo que su clasificación no puede cambiar.
+    """
+    diferencias = []
+    for capa in set(capas_viejas) | set(capas_nuevas):
+        viejas = capas_viejas.get(capa, {})
+        nuevas = capas_nuevas.get(capa, {})
+        for valor in set(viejas) | set(nuevas):
+            geom_vieja = viejas.get(valor)
+            geom_nueva = nuevas.get(valor)
+            if geom_vieja is None:
+                diferencias.append(geom_nueva)
+            elif geom_nueva is None:
+                diferencias.append(geom_vieja)
+            elif not geom_vieja.equals(geom_nueva):
+                diferencias.append(geom_vieja.symmetric_difference(geom_nueva))
+
+    diferencias = [d for d in diferencias if d is not None and not d.is_empty]
+    if not diferencias:
+        return None
+    return unary_union(diferencias)
@@ -1,4 +1,3 @@
-import requests
 import pandas as pd
 import geopandas as gpd
 from shapely.geometry import Point, Polygon
@@ -10,7 +9,21 @@ import os
 import json
 import sys
 import re
-import zipfile
+
+from baja_memoria import BAJA_MEMORIA, compactar, iterar_lotes, lote_como_objetos
+from sincronizacion import (
+    SINCRONIZACION_COMPLETA, cargar_indice, guardar_indice, validar_indice,
+    consultar_kobo, calcular_watermark, sincronizar_sheet, tabla_existe, merge_bigquery,
+    cargar_cola_bigquery, encolar_bigquery, vaciar_cola_bigquery
+)
+from clasificacion_paralela import usar_modo_paralelo, clasificar_en_paralelo
+from etapas import iniciar_corrida, ejecutar_etapa, finalizar_corrida
+from geometrias import (
+    POLIGONOS_RECORRIDO, COLUMNA_VERSION, buscar_columna_comuna,
+    cargar_capas, compilar_capas, guardar_instantanea
+)
+from particiones_sheet import PARTICIONADO, cargar_particionado
+from planificador_sheets import agrupar_escrituras, planificar_cliente
 
 # --- 1. CONFIGURACIÓN GLOBAL ---
 # Modificacion desde vscode
@@ -118,13 +131,7 @@ def clasificar_localizacion(puntos_gdf, palermo_gdf, anillo_digital_gdf, comunas
         
         if not puntos_en_comunas.empty:
             # Buscar columna de comuna dinámicamente
-            comuna_col_found = None
-            possible_cols = ['comunas', 'COMUNAS', 'comuna', 'COMUNA', 'NAM', 'ID', 'OBJETO', 'barrio']
-            
-            for col in possible_cols:
-                if col in puntos_en_comunas.columns:
-                    comuna_col_found = col
-                    break
+            comuna_col_found = buscar_columna_comuna(puntos_en_comunas.columns)
             
             if comuna_col_found:
                 # Convertir a float para mantener tipo numérico
@@ -135,16 +142,44 @@ def clasificar_localizacion(puntos_gdf, palermo_gdf, anillo_digital_gdf, comunas
     # Localizacion es float: 14.5=Palermo, 2.5=Anillo Digital, 1.0-15.0=Comunas, None=Fuera
     return puntos_gdf['Localizacion']
 
-def subir_a_bigquery(df):
+def credenciales_bigquery():
+    """
+    Credenciales de la Service Account para BigQuery: del secreto
+    GOOGLE_CREDENTIALS_JSON (GitHub Actions) o de un archivo local.
+    Devuelve None si no hay ninguna.
+    """
+    scopes = ["https://www.googleapis.com/auth/bigquery"]
+    if "GOOGLE_CREDENTIALS_JSON" in os.environ:
+        return service_account.Credentials.from_service_account_info(
+            json.loads(os.environ["GOOGLE_CREDENTIALS_JSON"]), scopes=scopes
+        )
+
+    possible_names = ['kobo-looker-connect.json', 'credenciales.json', 'service_account.json']
+    for name in possible_names:
+        for root, _, files in os.walk(BASE_DIR):
+            if name in files:
+                ruta_creds = os.path.join(root, name)
+                print(f"   ✅ Usando credenciales: {name}")
+                return service_account.Credentials.from_service_account_file(ruta_creds, scopes=scopes)
+    return None
+
+def subir_a_bigquery(df, modo='replace', id_corrida=None):
     """
     Sube el DataFrame a Google BigQuery.
     Trabaja sobre una copia para no afectar los datos de Sheets.
     Limpia nombres de columnas y sanitiza tipos para compatibilidad con BigQuery.
+    Con modo='upsert' carga a una tabla staging propia de la corrida y hace
+    MERGE por uuid, por lo que reintentar la misma corrida no duplica filas.
     """
     print("--- Preparando datos para BigQuery ---")
     
-    # 1. Clonar DataFrame
-    df_bq = df.copy()
+    # 0. Credenciales primero: sin ellas no tiene sentido copiar el DataFrame
+    credentials = credenciales_bigquery()
+    if credentials is None:
+        raise FileNotFoundError("No se encontraron credenciales de BigQuery (GOOGLE_CREDENTIALS_JSON o archivo .json)")
+    
+    # 1. Clonar DataFrame (en modo baja memoria sólo se renombran columnas)
+    df_bq = df.copy(deep=not BAJA_MEMORIA)
     
     # 2. Limpieza de nombres de columnas para BigQuery
     def limpiar_nombre_columna(nombre):
@@ -166,49 +201,68 @@ def subir_a_bigquery(df):
     print(f"   ✅ Nombres de columnas limpiados para BigQuery")
     
     # 3. Sanitización de tipos complejos (listas/diccionarios)
-    for col in df_bq.columns:
-        df_bq[col] = df_bq[col].apply(
-            lambda x: str(x) if isinstance(x, (list, dict)) else x
-        )
-    print(f"   ✅ Tipos de datos sanitizados")
-    
-    # 4. Buscar archivo de credenciales (reutilizar lógica del script)
-    possible_names = ['kobo-looker-connect.json', 'credenciales.json', 'service_account.json']
-    ruta_creds = None
+    # En modo baja memoria se hace al serializar cada lote
+    if not BAJA_MEMORIA:
+        for col in df_bq.columns:
+            df_bq[col] = df_bq[col].apply(
+                lambda x: str(x) if isinstance(x, (list, dict)) else x
+            )
+        print(f"   ✅ Tipos de datos sanitizados")
     
-    for name in possible_names:
-        for root, _, files in os.walk(BASE_DIR):
-            if name in files:
-                ruta_creds = os.path.join(root, name)
-                break
-        if ruta_creds:
-            break
-    
-    if not ruta_creds:
-        raise FileNotFoundError(f"No se encontró archivo de credenciales. Buscando: {', '.join(possible_names)}")
-    
-    print(f"   ✅ Usando credenciales: {os.path.basename(ruta_creds)}")
-    
-    # 5. Autenticación con BigQuery
-    credentials = service_account.Credentials.from_service_account_file(
-        ruta_creds,
-        scopes=["https://www.googleapis.com/auth/bigquery"]
-    )
-    
-    # 6. Carga a BigQuery
+    # 4-5. Autenticación con BigQuery
+    # 6. Carga a BigQuery (en upsert, primero a la tabla staging)
     table_full_id = f"{DATASET_ID}.{TABLE_ID}"
+    hacer_merge = False
+    if modo == 'upsert':
+        from google.cloud import bigquery
+        bq_client = bigquery.Client(project=PROJECT_ID, credentials=credentials)
+        if tabla_existe(bq_client, f"{PROJECT_ID}.{table_full_id}"):
+            table_full_id = f"{DATASET_ID}.{TABLE_ID}_staging_{id_corrida or 'manual'}"
+            hacer_merge = True
     print(f"   📤 Subiendo a BigQuery: {PROJECT_ID}.{table_full_id}")
     
-    df_bq.to_gbq(
-        destination_table=table_full_id,
-        project_id=PROJECT_ID,
-        credentials=credentials,
-        if_exists='replace',
-        progress_bar=False
-    )
+    if not BAJA_MEMORIA:
+        df_bq.to_gbq(
+            destination_table=table_full_id,
+            project_id=PROJECT_ID,
+            credentials=credentials,
+            if_exists='replace',
+            progress_bar=False
+        )
+    else:
+        # Modo baja memoria: se expande a objetos Python lote por lote
+        for inicio, lote in iterar_lotes(df_bq):
+            lote_como_objetos(lote).to_gbq(
+                destination_table=table_full_id,
+                project_id=PROJECT_ID,
+                credentials=credentials,
+                if_exists='replace' if inicio == 0 else 'append',
+                progress_bar=False
+            )
+
+    if hacer_merge:
+        print(f"   🔀 MERGE por uuid en {PROJECT_ID}.{DATASET_ID}.{TABLE_ID}")
+        merge_bigquery(bq_client, f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}", f"{PROJECT_ID}.{table_full_id}")
     
     print(f"   ✅ {len(df_bq)} registros cargados exitosamente a BigQuery")
 
+def asegurar_encabezado(sheet, columnas_deseadas):
+    """
+    Devuelve el encabezado del sheet, agregando al final las columnas
+    deseadas que todavía no existen (ej. version_geometria).
+    """
+    headers_sheet = sheet.row_values(1)
+    if not headers_sheet: headers_sheet = columnas_deseadas
+
+    columnas_faltantes = [c for c in columnas_deseadas if c not in headers_sheet]
+    if columnas_faltantes:
+        sheet.update(
+            range_name=gspread.utils.rowcol_to_a1(1, len(headers_sheet) + 1),
+            values=[columnas_faltantes]
+        )
+        headers_sheet = headers_sheet + columnas_faltantes
+    return headers_sheet
+
 def asignar_recorrido(gdf, poligonos):
     print("--- Clasificando Recorridos ---")
     resultado = pd.Series('', index=gdf.index, dtype=object)
@@ -250,125 +304,58 @@ def procesar_datos_geoespaciales_total(df_kobo):
     )
 
     try:
-        # Cargar Palermo Norte KMZ
-        print("📂 Cargando archivo Palermo Norte...")
-        with zipfile.ZipFile(RUTA_KMZ_PALERMO, 'r') as kmz:
-            kml_files = [f for f in kmz.namelist() if f.endswith('.kml')]
-            if kml_files:
-                with kmz.open(kml_files[0]) as kml_file:
-                    palermo_gdf = gpd.read_file(kml_file)
-            else:
-                raise FileNotFoundError("No se encontró KML dentro de Palermo_Norte.kmz")
-        if palermo_gdf.crs is None: palermo_gdf.set_crs("EPSG:4326", inplace=True)
-        
-        # Cargar Anillo Digital C2 KMZ
-        print("📂 Cargando archivo Anillo Digital C2...")
-        with zipfile.ZipFile(RUTA_KML_ANILLO_DIGITAL, 'r') as kmz:
-            kml_files = [f for f in kmz.namelist() if f.endswith('.kml')]
-            if kml_files:
-                with kmz.open(kml_files[0]) as kml_file:
-                    anillo_digital_gdf = gpd.read_file(kml_file)
-            else:
-                raise FileNotFoundError("No se encontró KML dentro de anillo_digital_c2.kmz")
-        if anillo_digital_gdf.crs is None: anillo_digital_gdf.set_crs("EPSG:4326", inplace=True)
-        
-        # Cargar comunas SHP
-        print("📂 Cargando shapefile de comunas...")
-        comunas_gdf = gpd.read_file(RUTA_SHP_COMUNAS)
-        
+        palermo_gdf, anillo_digital_gdf, comunas_gdf = cargar_capas(
+            RUTA_KMZ_PALERMO, RUTA_KML_ANILLO_DIGITAL, RUTA_SHP_COMUNAS
+        )
     except Exception as e:
         print(f"❌ ERROR FATAL CARGANDO CAPAS: {e}")
         sys.exit(1)
 
-    poligonos_recorrido = {
-        'Recorrido A': Polygon([(-58.41017, -34.588232), (-58.413901, -34.594177), (-58.413904, -34.599714),(-58.400064, -34.600033), (-58.386224, -34.599855), (-58.398154, -34.59498),(-58.404592, -34.593108), (-58.386524, -34.595263), (-58.41017, -34.588232)]),
-        'Recorrido B': Polygon([(-58.389185, -34.584593), (-58.395365, -34.587137), (-58.400944, -34.594168),(-58.398154, -34.59498), (-58.386524, -34.595263), (-58.383284, -34.587544),(-58.388112, -34.59256), (-58.389185, -34.584593)]),
-        'Recorrido C': Polygon([(-58.400944, -34.594168), (-58.395365, -34.587137), (-58.389185, -34.584593),(-58.398455, -34.580212), (-58.407295, -34.581837), (-58.404592, -34.593108),(-58.41017, -34.588232), (-58.400944, -34.594168)])
-    }
+    # Versión de las geometrías con las que se clasifica esta corrida
+    capas = compilar_capas(palermo_gdf, anillo_digital_gdf, comunas_gdf, POLIGONOS_RECORRIDO)
+    version = guardar_instantanea(capas)
+    print(f"   🏷️ Versión de geometrías: {version}")
 
-    df_kobo['Localizacion'] = clasificar_localizacion(puntos_gdf, palermo_gdf, anillo_digital_gdf, comunas_gdf)
-    df_kobo['Poligono'] = asignar_recorrido(puntos_gdf, poligonos_recorrido)
+    if usar_modo_paralelo(len(df_kobo)):
+        # Backfills grandes: pool de procesos por teselas con geometrías en memoria compartida
+        df_kobo['Localizacion'], df_kobo['Poligono'] = clasificar_en_paralelo(df_kobo.longitude, df_kobo.latitude, capas)
+    else:
+        df_kobo['Localizacion'] = clasificar_localizacion(puntos_gdf, palermo_gdf, anillo_digital_gdf, comunas_gdf)
+        df_kobo['Poligono'] = asignar_recorrido(puntos_gdf, POLIGONOS_RECORRIDO)
+    df_kobo[COLUMNA_VERSION] = version
 
     return df_kobo
 
 
-# --- 4. MAIN EJECUCIÓN ---
-
-if __name__ == '__main__':
-    print(">>> INICIO DE PROCESO INTEGRADO (ESTRICTO + JSON COMPLIANT) <<<")
-    
-    # 1. KOBO
-    print("1. Descargando Kobo Completo...")
-    headers = {"Authorization": f"Token {TOKEN_KOBO}"}
-    try:
-        resp = requests.get(URL_KOBO, headers=headers)
-        resp.raise_for_status()
-        df_raw = pd.json_normalize(resp.json()['results'])
-    except Exception as e:
-        print(f"Error Kobo: {e}")
-        sys.exit(1)
-
-    if df_raw.empty: sys.exit(0)
-
-    # 2. PROCESAR GEOESPACIALMENTE
-    print("2. Procesando lógica geoespacial...")
+COLUMNAS_DESEADAS = [
+    'Turno', 'start', 'hora_start', 'end', 'today', 'username', 'deviceid',
+    'Georreferenciación del punto', 'latitude', 'longitude',
+    '_Georreferenciación del punto_altitude', '_Georreferenciación del punto_precision',
+    'Cantidad de personas en situación de calle observadas',
+    'Características observables del punto', 'estructura', 'colchon',
+    'Características observables del punto/Basura, ropa, bolsos, etc',
+    'Características observables del punto/No se observan cosas',
+    'Se observan niños/as en el punto', '_id', '_uuid', '_submission_time', 
+    '_validation_status', '_notes', '_status', '_submitted_by', '__version__', 
+    '_tags', '_index', 'Poligono', 'Localizacion', COLUMNA_VERSION
+]
+
+def clasificar_envios(df_raw):
+    """Etapa de clasificación: lógica geoespacial (+ tipos compactos en modo baja memoria)."""
     df_procesado = procesar_datos_geoespaciales_total(df_raw)
-    
-    if df_procesado is None or df_procesado.empty: sys.exit(1)
-
-    # 3. GOOGLE SHEETS & DUPLICADOS
-    print("3. Verificando duplicados...")
-    scope = ["https://spreadsheets.google.com/feeds", 'https://www.googleapis.com/auth/spreadsheets',
-             "https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/drive"]
+    if df_procesado is None or df_procesado.empty:
+        return df_procesado
 
-    if "GOOGLE_CREDENTIALS_JSON" in os.environ:
-        creds_dict = json.loads(os.environ["GOOGLE_CREDENTIALS_JSON"])
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-    else:
-        # Buscar archivo de credenciales con múltiples nombres posibles
-        possible_names = ['kobo-looker-connect.json', 'credenciales.json', 'service_account.json']
-        ruta_creds = None
-        
-        for name in possible_names:
-            for root, _, files in os.walk(BASE_DIR):
-                if name in files:
-                    ruta_creds = os.path.join(root, name)
-                    print(f"✅ Credenciales encontradas: {name}")
-                    break
-            if ruta_creds:
-                break
-        
-        if not ruta_creds:
-            print("❌ ERROR: No se encontró archivo de credenciales")
-            print(f"   Buscando: {', '.join(possible_names)}")
-            sys.exit(1)
-        
-        creds = ServiceAccountCredentials.from_json_keyfile_name(ruta_creds, scope)
+    if BAJA_MEMORIA:
+        print("   🧮 Modo baja memoria: compactando tipos de datos...")
+        df_procesado = compactar(df_procesado)
 
-    client = gspread.authorize(creds)
-    try:
-        sheet = client.open(NOMBRE_SPREADSHEET).worksheet(NOMBRE_HOJA)
-        registros = sheet.get_all_records()
-        ids_existentes = set(str(r['_uuid']) for r in registros) if registros and '_uuid' in registros[0] else set()
-    except:
-        ids_existentes = set()
-    
-    # 4. FILTRAR NUEVOS
     if '_uuid' in df_procesado.columns:
         df_procesado['_uuid'] = df_procesado['_uuid'].astype(str)
-        df_nuevos_final = df_procesado[~df_procesado['_uuid'].isin(ids_existentes)].copy()
-    else:
-        df_nuevos_final = df_procesado
-
-    if df_nuevos_final.empty:
-        print(">>> Todo actualizado. No hay registros nuevos. <<<")
-        sys.exit(0)
+    return df_procesado
 
-    print(f"   > Registros NUEVOS a subir: {len(df_nuevos_final)}")
-
-    # 5. FORMATEO ESTRICTO
-    print("4. Aplicando formatos estrictos...")
-    
+def formatear_salida(df_nuevos_final):
+    """Etapa de formato: columnas, nombres y tipos estrictos para Sheets/BigQuery."""
     df_nuevos_final['hora_start'] = df_nuevos_final['start'].dt.strftime('%H:%M:%S')
     df_nuevos_final['start'] = df_nuevos_final['start'].dt.strftime('%Y-%m-%d')
 
@@ -382,20 +369,7 @@ if __name__ == '__main__':
     }
     df_nuevos_final.rename(columns=rename_map, inplace=True)
 
-    columnas_deseadas = [
-        'Turno', 'start', 'hora_start', 'end', 'today', 'username', 'deviceid',
-        'Georreferenciación del punto', 'latitude', 'longitude',
-        '_Georreferenciación del punto_altitude', '_Georreferenciación del punto_precision',
-        'Cantidad de personas en situación de calle observadas',
-        'Características observables del punto', 'estructura', 'colchon',
-        'Características observables del punto/Basura, ropa, bolsos, etc',
-        'Características observables del punto/No se observan cosas',
-        'Se observan niños/as en el punto', '_id', '_uuid', '_submission_time', 
-        '_validation_status', '_notes', '_status', '_submitted_by', '__version__', 
-        '_tags', '_index', 'Poligono', 'Localizacion'
-    ]
-    
-    df_final = df_nuevos_final.reindex(columns=columnas_deseadas)
+    df_final = df_nuevos_final.reindex(columns=COLUMNAS_DESEADAS)
 
     # FORMATO: Numéricos (Float)
     cols_float = ['latitude', 'longitude', '_Georreferenciación del punto_altitude', '_Georreferenciación del punto_precision']
@@ -412,11 +386,15 @@ if __name__ == '__main__':
 
     # FORMATO: Localización (ya viene como float desde clasificar_localizacion)
     # 14.5 = Palermo Norte, 2.5 = Anillo Digital C2, 1.0-15.0 = Comunas, None = Fuera de zona
-    if 'Localizacion' in df_final.columns:
+    if 'Localizacion' in df_final.columns and not isinstance(df_final['Localizacion'].dtype, pd.CategoricalDtype):
         df_final['Localizacion'] = pd.to_numeric(df_final['Localizacion'], errors='coerce')
 
+    if BAJA_MEMORIA:
+        # La limpieza para JSON (listas, inf, NaN -> None) se hace al serializar cada lote
+        return compactar(df_final)
+
     # LIMPIEZA CRÍTICA PARA JSON (Evita error 'Out of range float values' y 'list_value')
-    
+
     def clean_complex_types(val):
         if isinstance(val, (list, dict)):
             return str(val)
@@ -433,28 +411,150 @@ if __name__ == '__main__':
 
     # 4. Reemplazar NaN con None
     df_final = df_final.where(pd.notnull(df_final), None)
+    return df_final
+
+def conectar_cliente():
+    """Autentica con Google y devuelve el cliente de gspread."""
+    scope = ["https://spreadsheets.google.com/feeds", 'https://www.googleapis.com/auth/spreadsheets',
+             "https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/drive"]
 
-    print("5. Subiendo a Google Sheets...")
-    if len(ids_existentes) == 0:
-        sheet.clear()
-        sheet.update(values=[df_final.columns.values.tolist()] + df_final.values.tolist(), value_input_option='USER_ENTERED')
+    if "GOOGLE_CREDENTIALS_JSON" in os.environ:
+        creds_dict = json.loads(os.environ["GOOGLE_CREDENTIALS_JSON"])
+        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
     else:
-        headers_sheet = sheet.row_values(1)
-        if not headers_sheet: headers_sheet = columnas_deseadas
+        # Buscar archivo de credenciales con múltiples nombres posibles
+        possible_names = ['kobo-looker-connect.json', 'credenciales.json', 'service_account.json']
+        ruta_creds = None
+        
+        for name in possible_names:
+            for root, _, files in os.walk(BASE_DIR):
+                if name in files:
+                    ruta_creds = os.path.join(root, name)
+                    print(f"✅ Credenciales encontradas: {name}")
+                    break
+            if ruta_creds:
+                break
         
-        df_append = df_final.reindex(columns=headers_sheet)
-        df_append = df_append.astype(object)
-        df_append = df_append.where(pd.notnull(df_append), None)
+        if not ruta_creds:
+            print("❌ ERROR: No se encontró archivo de credenciales")
+            print(f"   Buscando: {', '.join(possible_names)}")
+            sys.exit(1)
         
-        sheet.append_rows(values=df_append.values.tolist(), value_input_option='USER_ENTERED')
+        creds = ServiceAccountCredentials.from_json_keyfile_name(ruta_creds, scope)
+
+    return planificar_cliente(gspread.authorize(creds))
 
-    # 6. SUBIR A BIGQUERY
-    print("6. Subiendo a BigQuery...")
+def conectar_sheet():
+    """Devuelve el worksheet de destino."""
+    return conectar_cliente().open(NOMBRE_SPREADSHEET).worksheet(NOMBRE_HOJA)
+
+def cargar_en_sheets(df_final, indice, nuevo_watermark):
+    """
+    Etapa de carga a Sheets: upsert por _uuid. El índice se guarda después de
+    cada lote, así un reintento no vuelve a anexar filas ya escritas.
+    Devuelve la lista de _uuid escritos.
+    """
+    if PARTICIONADO:
+        # Cada partición lleva su propio índice; el principal guarda la marca de agua
+        uuids_escritos = cargar_particionado(
+            conectar_cliente(), df_final, COLUMNAS_DESEADAS, NOMBRE_SPREADSHEET,
+            NOMBRE_HOJA, COLUMNA_VERSION, asegurar_encabezado
+        )
+        indice = cargar_indice()
+        indice['watermark'] = nuevo_watermark
+        guardar_indice(indice)
+        return uuids_escritos
+
+    client = conectar_cliente()
+    sheet = client.open(NOMBRE_SPREADSHEET).worksheet(NOMBRE_HOJA)
+    indice = validar_indice(sheet, indice)
+    print(f"   > Envíos a comparar: {len(df_final)} (índice con {len(indice['filas'])} filas)")
+
+    # El encabezado y las filas editadas del primer lote salen en un solo pedido
+    with agrupar_escrituras(client):
+        if not indice['filas']:
+            # Sheet vacío: encabezado completo y todas las filas como nuevas
+            sheet.clear()
+            sheet.update(values=[COLUMNAS_DESEADAS], value_input_option='USER_ENTERED')
+        headers_sheet = asegurar_encabezado(sheet, COLUMNAS_DESEADAS)
+        uuids_escritos = sincronizar_sheet(sheet, df_final, headers_sheet, indice, al_terminar_lote=guardar_indice)
+
+    indice['watermark'] = nuevo_watermark
+    guardar_indice(indice)
+    return sorted(uuids_escritos)
+
+def cargar_cola_en_bigquery(id_corrida):
+    """
+    MERGE en BigQuery de la cola de filas pendientes: las de esta corrida más
+    las que quedaron de corridas anteriores por un error de BigQuery. Un error
+    no es crítico: las filas siguen en la cola y la próxima corrida las reintenta.
+    """
+    df_bq = cargar_cola_bigquery()
+    if df_bq is None or df_bq.empty:
+        return
+    print(f"5. Subiendo a BigQuery ({len(df_bq)} filas en cola)...")
     try:
-        subir_a_bigquery(df_final)
-        print("   ✅ Carga a BigQuery exitosa")
+        subir_a_bigquery(df_bq, modo='upsert', id_corrida=id_corrida)
     except Exception as e:
         print(f"   ⚠️  Error en BigQuery (no crítico): {e}")
         print(f"   ℹ️  La carga a Google Sheets se completó correctamente")
+        print(f"   ℹ️  Las filas quedan en cola y se reintentan en la próxima ejecución")
+        return
+    vaciar_cola_bigquery()
+    print("   ✅ Carga a BigQuery exitosa")
+
 
+# --- 4. MAIN EJECUCIÓN ---
+
+if __name__ == '__main__':
+    print(">>> INICIO DE PROCESO INTEGRADO (ESTRICTO + JSON COMPLIANT) <<<")
+    corrida = iniciar_corrida('main_act_flash')
+    indice = cargar_indice()
+    
+    # 1. KOBO
+    print("1. Descargando Kobo...")
+    watermark = None if SINCRONIZACION_COMPLETA else indice['watermark']
+    headers = {"Authorization": f"Token {TOKEN_KOBO}"}
+    try:
+        df_raw = ejecutar_etapa(corrida, 'extraccion', lambda: consultar_kobo(URL_KOBO, headers, watermark))
+    except Exception as e:
+        print(f"Error Kobo: {e}")
+        sys.exit(1)
+
+    if df_raw.empty:
+        print(">>> Todo actualizado. No hay envíos nuevos ni modificados en Kobo. <<<")
+        finalizar_corrida(corrida)
+        cargar_cola_en_bigquery(corrida['id'])
+        sys.exit(0)
+    nuevo_watermark = calcular_watermark(df_raw, indice['watermark'])
+
+    # 2. PROCESAR GEOESPACIALMENTE
+    print("2. Procesando lógica geoespacial...")
+    df_procesado = ejecutar_etapa(corrida, 'clasificacion', lambda: clasificar_envios(df_raw))
+    
+    if df_procesado is None or df_procesado.empty: sys.exit(1)
+
+    # 3. FORMATEO ESTRICTO
+    print("3. Aplicando formatos estrictos...")
+    df_final = ejecutar_etapa(corrida, 'formato', lambda: formatear_salida(df_procesado))
+
+    # 4. GOOGLE SHEETS (upsert por _uuid)
+    print("4. Sincronizando Google Sheets (upsert por _uuid)...")
+    uuids_escritos = ejecutar_etapa(corrida, 'carga_sheets', lambda: cargar_en_sheets(df_final, indice, nuevo_watermark))
+
+    # 5. SUBIR A BIGQUERY
+    # Lo escrito en Sheets pasa a la cola de BigQuery y la corrida se cierra:
+    # un error de BigQuery no debe frenar las próximas cargas a Sheets.
+    # Sin credenciales de BigQuery no se encola (la cola sólo crecería)
+    if uuids_escritos:
+        if credenciales_bigquery() is not None:
+            encolar_bigquery(df_final[df_final['_uuid'].isin(uuids_escritos)])
+        else:
+            print("   ⚠️  Sin credenciales de BigQuery: se omite la carga a BigQuery")
+    finalizar_corrida(corrida)
+    cargar_cola_en_bigquery(corrida['id'])
+
+    if not uuids_escritos:
+        print(">>> Todo actualizado. No hay registros nuevos ni modificados. <<<")
+        sys.exit(0)
     print(">>> ÉXITO: Carga completada. <<<")
@@ -0,0 +1,381 @@
+"""
+Particionado del Sheet por trimestre
+====================================
+
+Con KOBO_HOJAS_PARTICIONADAS=1 los datos dejan de crecer en una sola hoja:
+cuando la hoja activa supera KOBO_UMBRAL_CELDAS celdas (filas × columnas,
+4.000.000 por defecto) se abre una hoja nueva `<NOMBRE_HOJA>_<AAAA>T<n>`
+(ej. `Sheet4_2025T3`) desde el trimestre siguiente al último envío de la
+activa. No es una hoja por trimestre: la nueva recibe ese trimestre y todos
+los posteriores hasta llenarse a su vez.
+
+Un manifiesto (hoja `_particiones` del spreadsheet principal) registra cada
+partición: hoja, spreadsheet, desde qué `_submission_time` cubre, su último
+envío, cantidad de filas, versiones de geometría presentes y bounding box de
+sus puntos.
+- La carga envía cada fila a la partición que cubre su `_submission_time`
+  (o a la que ya tiene su `_uuid`) y sólo escribe en las hojas que reciben
+  filas en esa corrida.
+- La reclasificación salta las particiones que ya están en la versión
+  actual o cuyo bounding box no toca el área modificada.
+
+El límite de celdas de Google (10.000.000) aplica a todo el spreadsheet,
+contando todas sus hojas: con KOBO_SPREADSHEET_PARTICIONES=<nombre> las
+particiones nuevas se crean en otro spreadsheet (ya existente y compartido con
+la cuenta de servicio). Si el spreadsheet de destino no tiene lugar para una
+partición completa (KOBO_UMBRAL_CELDAS celdas más), la carga se detiene antes
+de escribir y pide configurar (o cambiar) KOBO_SPREADSHEET_PARTICIONES.
+"""
+
+import json
+import os
+import re
+
+import pandas as pd
+from shapely.geometry import box
+
+from geometrias import cargar_instantanea, area_afectada
+from planificador_sheets import agrupar_escrituras
+from sincronizacion import (
+    cargar_indice, guardar_indice, validar_indice, sincronizar_sheet
+)
+
+PARTICIONADO = os.environ.get("KOBO_HOJAS_PARTICIONADAS", "").lower() in ('1', 'true', 'si', 'sí')
+UMBRAL_CELDAS = int(os.environ.get("KOBO_UMBRAL_CELDAS", "4000000"))
+SPREADSHEET_PARTICIONES = os.environ.get("KOBO_SPREADSHEET_PARTICIONES")
+# Límite de Google por spreadsheet (celdas de la grilla de todas sus hojas)
+LIMITE_CELDAS_SPREADSHEET = 10_000_000
+# Hoja del spreadsheet principal con el manifiesto (una fila por partición)
+HOJA_MANIFIESTO = '_particiones'
+CAMPOS_MANIFIESTO = ['hoja', 'spreadsheet', 'desde', 'ultimo', 'filas', 'versiones', 'bbox']
+
+
+def inicio_trimestre(fecha):
+    """'2025-08-14T10:00:00' → ('2025T3', '2025-07-01T00:00:00')."""
+    fecha = pd.Timestamp(fecha)
+    trimestre = (fecha.month - 1) // 3 + 1
+    return f"{fecha.year}T{trimestre}", f"{fecha.year}-{3 * (trimestre - 1) + 1:02d}-01T00:00:00"
+
+
+def trimestre_siguiente(fecha):
+    """'2025-08-14T10:00:00' → '2025-10-01T00:00:00'."""
+    fecha = pd.Timestamp(fecha)
+    trimestre = (fecha.month - 1) // 3 + 1
+    if trimestre == 4:
+        return f"{fecha.year + 1}-01-01T00:00:00"
+    return f"{fecha.year}-{3 * trimestre + 1:02d}-01T00:00:00"
+
+
+def hoja_indice(particion, hoja_base):
+    """La hoja base usa el índice principal; el resto, uno propio por hoja."""
+    return None if particion['hoja'] == hoja_base else particion['hoja']
+
+
+# --- MANIFIESTO ---
+
+def _hoja_manifiesto(client, nombre_spreadsheet, crear=False):
+    import gspread
+    spreadsheet = client.open(nombre_spreadsheet)
+    try:
+        return spreadsheet.worksheet(HOJA_MANIFIESTO)
+    except gspread.exceptions.WorksheetNotFound:
+        if not crear:
+            return None
+        return spreadsheet.add_worksheet(title=HOJA_MANIFIESTO, rows=1000, cols=len(CAMPOS_MANIFIESTO))
+
+
+def guardar_manifiesto(client, manifiesto):
+    """Escribe el manifiesto en la hoja `_particiones` (las particiones sólo se agregan, nunca se borran)."""
+    filas = [CAMPOS_MANIFIESTO] + [
+        [p['hoja'], p['spreadsheet'], p['desde'] or '', p.get('ultimo') or '', p['filas'],
+         json.dumps(p['versiones']), json.dumps(p['bbox'])]
+        for p in manifiesto['particiones']
+    ]
+    sheet = _hoja_manifiesto(client, manifiesto['spreadsheet'], crear=True)
+    sheet.update(values=filas, range_name='A1', value_input_option='RAW')
+
+
+def _leer_manifiesto(sheet):
+    particiones = []
+    for fila in sheet.get_all_values()[1:]:
+        registro = dict(zip(CAMPOS_MANIFIESTO, fila + [''] * (len(CAMPOS_MANIFIESTO) - len(fila))))
+        if not registro['hoja']:
+            continue
+        particiones.append({
+            'hoja': registro['hoja'], 'spreadsheet': registro['spreadsheet'],
+            'desde': registro['desde'] or None, 'ultimo': registro['ultimo'] or None,
+            'filas': int(registro['filas'] or 0),
+            'versiones': json.loads(registro['versiones'] or 'null'),
+            'bbox': json.loads(registro['bbox'] or 'null'),
+        })
+    return particiones
+
+
+def cargar_manifiesto(client, nombre_spreadsheet, hoja_base):
+    """
+    Lee el manifiesto de la hoja `_particiones` del spreadsheet principal,
+    así la corrida en GitHub Actions y la reclasificación en la máquina de un
+    operador ven el mismo. Si no existe se reconstruye a partir de las hojas
+    `<hoja_base>` y `<hoja_base>_AAAATn` (sin versiones ni bounding box, que
+    se completan en las próximas cargas).
+    """
+    sheet = _hoja_manifiesto(client, nombre_spreadsheet)
+    if sheet is not None:
+        particiones = _leer_manifiesto(sheet)
+        if particiones:
+            return {'hoja_base': hoja_base, 'spreadsheet': nombre_spreadsheet, 'particiones': particiones}
+
+    print("   🔨 Reconstruyendo manifiesto de particiones desde el spreadsheet...")
+    patron = re.compile(rf"^{re.escape(hoja_base)}_(\d{{4}})T([1-4])$")
+    particiones = []
+    spreadsheets = [nombre_spreadsheet] + ([SPREADSHEET_PARTICIONES] if SPREADSHEET_PARTICIONES else [])
+    for nombre in spreadsheets:
+        for ws in client.open(nombre).worksheets():
+            match = patron.match(ws.title)
+            if ws.title == hoja_base and nombre == nombre_spreadsheet:
+                desde = None
+            elif match:
+                desde = f"{match.group(1)}-{3 * (int(match.group(2)) - 1) + 1:02d}-01T00:00:00"
+            else:
+                continue
+            particiones.append({
+                'hoja': ws.title, 'spreadsheet': nombre, 'desde': desde, 'ultimo': ultimo_envio(ws),
+                'filas': max(len(ws.col_values(1)) - 1, 0), 'versiones': None, 'bbox': None
+            })
+
+    if not any(p['desde'] is None for p in particiones):
+        particiones.append({'hoja': hoja_base, 'spreadsheet': nombre_spreadsheet, 'desde': None,
+                            'ultimo': None, 'filas': 0, 'versiones': [], 'bbox': None})
+    particiones.sort(key=lambda p: p['desde'] or '')
+    manifiesto = {'hoja_base': hoja_base, 'spreadsheet': nombre_spreadsheet, 'particiones': particiones}
+    guardar_manifiesto(client, manifiesto)
+    return manifiesto
+
+
+def particion_para(manifiesto, submission_time):
+    """Partición con el mayor `desde` <= submission_time."""
+    elegida = manifiesto['particiones'][0]
+    for particion in manifiesto['particiones']:
+        if particion['desde'] is None or (submission_time and str(submission_time) >= particion['desde']):
+            elegida = particion
+    return elegida
+
+
+def celdas_spreadsheet(client, nombre_spreadsheet):
+    """Celdas de la grilla de todas las hojas del spreadsheet (lo que cuenta para el límite de Google)."""
+    return sum(ws.row_count * ws.col_count for ws in client.open(nombre_spreadsheet).worksheets())
+
+
+def repartir(manifiesto, df_final, cantidad_columnas, nombre_spreadsheet, ubicacion=None, celdas=None):
+    """
+    Asigna cada fila a su partición. Si la última partición superó el umbral
+    (o su spreadsheet está cerca del límite de Google) y llegan filas
+    posteriores al trimestre de su último envío, abre una partición nueva
+    desde el trimestre siguiente (los envíos de ese trimestre, nuevos o
+    editados, siguen en la activa). Un _uuid que ya está en alguna partición
+    (`ubicacion`: _uuid → hoja) se actualiza ahí.
+    `celdas` ({spreadsheet: celdas usadas}) permite verificar que el destino
+    de la partición nueva tenga lugar para ella; si no lo tiene se lanza
+    RuntimeError antes de escribir nada.
+    Devuelve {hoja: DataFrame}.
+    """
+    celdas = celdas or {}
+    tiempos = df_final['_submission_time'].astype(str)
+    activa = manifiesto['particiones'][-1]
+    llena = (activa['filas'] * cantidad_columnas >= UMBRAL_CELDAS
+             or celdas.get(activa['spreadsheet'], 0) + UMBRAL_CELDAS > LIMITE_CELDAS_SPREADSHEET)
+    if llena and activa.get('ultimo'):
+        posteriores = tiempos[tiempos >= trimestre_siguiente(activa['ultimo'])]
+        if not posteriores.empty:
+            destino = SPREADSHEET_PARTICIONES or nombre_spreadsheet
+            if celdas.get(destino, 0) + UMBRAL_CELDAS > LIMITE_CELDAS_SPREADSHEET:
+                raise RuntimeError(
+                    f"El spreadsheet '{destino}' ya usa {celdas[destino]} celdas y no tiene lugar para una "
+                    f"partición nueva de {UMBRAL_CELDAS} (límite de Google: {LIMITE_CELDAS_SPREADSHEET}). "
+                    "Configurar KOBO_SPREADSHEET_PARTICIONES con otro spreadsheet compartido con la cuenta de servicio."
+                )
+            sufijo, desde = inicio_trimestre(posteriores.min())
+            nueva = {
+                'hoja': f"{manifiesto['hoja_base']}_{sufijo}",
+                'spreadsheet': destino,
+                'desde': desde, 'ultimo': None, 'filas': 0, 'versiones': [], 'bbox': None
+            }
+            manifiesto['particiones'].append(nueva)
+            print(f"   📑 Hoja {activa['hoja']} llena ({activa['filas']} filas): nueva partición {nueva['hoja']} en '{destino}'")
+
+    hojas = tiempos.map(lambda t: particion_para(manifiesto, t)['hoja'])
+    if ubicacion:
+        existentes = df_final['_uuid'].astype(str).map(ubicacion)
+        movidas = int((existentes.notna() & (existentes != hojas)).sum())
+        if movidas:
+            print(f"   🔁 {movidas} envíos ya cargados en otra partición: se actualizan donde están")
+        hojas = existentes.fillna(hojas)
+    return {hoja: df_final[hojas == hoja] for hoja in hojas.unique()}
+
+
+def _actualizar_estadisticas(particion, df, filas, columna_version):
+    particion['filas'] = filas
+    if df.empty:
+        return
+    if columna_version in df.columns:
+        versiones = set(particion['versiones'] or []) | set(df[columna_version].dropna().astype(str))
+        particion['versiones'] = sorted(versiones)
+    if 'longitude' not in df.columns or 'latitude' not in df.columns:
+        return
+    lon = pd.to_numeric(df['longitude'], errors='coerce').dropna()
+    lat = pd.to_numeric(df['latitude'], errors='coerce').dropna()
+    if not lon.empty and not lat.empty:
+        bbox = [lon.min(), lat.min(), lon.max(), lat.max()]
+        if particion['bbox']:
+            viejo = particion['bbox']
+            bbox = [min(viejo[0], bbox[0]), min(viejo[1], bbox[1]), max(viejo[2], bbox[2]), max(viejo[3], bbox[3])]
+        particion['bbox'] = [float(v) for v in bbox]
+
+
+# --- CARGA ---
+
+def abrir_particion(client, particion, columnas):
+    """Abre la hoja de la partición, creándola si todavía no existe."""
+    import gspread
+    spreadsheet = client.open(particion['spreadsheet'])
+    try:
+        return spreadsheet.worksheet(particion['hoja'])
+    except gspread.exceptions.WorksheetNotFound:
+        print(f"   ➕ Creando hoja {particion['hoja']} en '{particion['spreadsheet']}'")
+        return spreadsheet.add_worksheet(title=particion['hoja'], rows=1000, cols=len(columnas))
+
+
+def ultimo_envio(sheet):
+    """Mayor _submission_time de la hoja (None si no tiene la columna o está vacía)."""
+    encabezado = sheet.row_values(1)
+    if '_submission_time' not in encabezado:
+        return None
+    valores = pd.to_datetime(pd.Series(sheet.col_values(encabezado.index('_submission_time') + 1)[1:]), errors='coerce').dropna()
+    return valores.max().strftime('%Y-%m-%dT%H:%M:%S') if not valores.empty else None
+
+
+def ubicar_uuids(client, manifiesto, columnas):
+    """
+    _uuid → hoja según los índices de todas las particiones. Los índices que
+    faltan localmente se reconstruyen desde su hoja, para no volver a anexar
+    en otra partición una fila que ya existe.
+    """
+    hoja_base = manifiesto['hoja_base']
+    ubicacion = {}
+    for particion in manifiesto['particiones']:
+        nombre_indice = hoja_indice(particion, hoja_base)
+        indice = cargar_indice(nombre_indice)
+        if indice.get('nuevo') and particion['filas']:
+            indice = validar_indice(abrir_particion(client, particion, columnas), indice)
+            guardar_indice(indice, nombre_indice)
+        for uuid in indice['filas']:
+            ubicacion[uuid] = particion['hoja']
+    return ubicacion
+
+
+def cargar_particionado(client, df_final, columnas, nombre_spreadsheet, hoja_base, columna_version, asegurar_encabezado):
+    """
+    Upsert por _uuid en cada partición que recibe filas. Devuelve la lista
+    de _uuid escritos.
+    """
+    manifiesto = cargar_manifiesto(client, nombre_spreadsheet, hoja_base)
+    activa = manifiesto['particiones'][-1]
+    destinos = {activa['spreadsheet'], SPREADSHEET_PARTICIONES or nombre_spreadsheet}
+    celdas = {nombre: celdas_spreadsheet(client, nombre) for nombre in destinos}
+    cerca_del_limite = celdas[activa['spreadsheet']] + UMBRAL_CELDAS > LIMITE_CELDAS_SPREADSHEET
+    if cerca_del_limite:
+        print(f"   ⚠️ El spreadsheet '{activa['spreadsheet']}' usa {celdas[activa['spreadsheet']]} celdas "
+              f"de {LIMITE_CELDAS_SPREADSHEET}: los próximos trimestres van a una partición nueva")
+    if (cerca_del_limite or activa['filas'] * len(columnas) >= UMBRAL_CELDAS) and not activa.get('ultimo'):
+        activa['ultimo'] = ultimo_envio(abrir_particion(client, activa, columnas))
+    ubicacion = ubicar_uuids(client, manifiesto, columnas)
+    por_hoja = repartir(manifiesto, df_final, len(columnas), nombre_spreadsheet, ubicacion, celdas)
+    escritos = set()
+
+    # Encabezados, filas editadas y manifiesto de un mismo spreadsheet salen juntos
+    with agrupar_escrituras(client):
+        for hoja, df_hoja in por_hoja.items():
+            particion = next(p for p in manifiesto['particiones'] if p['hoja'] == hoja)
+            nombre_indice = hoja_indice(particion, hoja_base)
+            print(f"   📄 Partición {hoja}: {len(df_hoja)} envíos")
+
+            sheet = abrir_particion(client, particion, columnas)
+            indice = validar_indice(sheet, cargar_indice(nombre_indice))
+            if not indice['filas']:
+                sheet.clear()
+                sheet.update(values=[columnas], value_input_option='USER_ENTERED')
+            headers_sheet = asegurar_encabezado(sheet, columnas)
+
+            escritos |= sincronizar_sheet(
+                sheet, df_hoja, headers_sheet, indice,
+                al_terminar_lote=lambda i, nombre=nombre_indice: guardar_indice(i, nombre)
+            )
+            guardar_indice(indice, nombre_indice)
+
+            _actualizar_estadisticas(particion, df_hoja, len(indice['filas']), columna_version)
+            tiempos = df_hoja['_submission_time'].dropna().astype(str)
+            if not tiempos.empty:
+                particion['ultimo'] = max(t for t in [particion.get('ultimo'), tiempos.max()] if t)
+            guardar_manifiesto(client, manifiesto)
+
+    return sorted(escritos)
+
+
+# --- RECLASIFICACIÓN ---
+
+def particiones_a_reclasificar(manifiesto, capas_actuales, version_actual, completo=False):
+    """
+    Decide qué hacer con cada partición. Devuelve [(particion, accion)] con:
+    - 'al_dia': vacía o ya en la versión actual.
+    - 'solo_version': su bounding box no toca el área modificada desde ninguna
+      de sus versiones; sólo se escribe la columna de versión, sin descargarla.
+    - 'reclasificar': se descarga y reclasifica (también si sus versiones o su
+      bounding box son desconocidos).
+    """
+    areas = {}
+    plan = []
+    for particion in manifiesto['particiones']:
+        versiones = particion.get('versiones')
+        if completo or versiones is None or (particion['filas'] and not particion.get('bbox')):
+            plan.append((particion, 'reclasificar'))
+            continue
+        pendientes = [v for v in versiones if v != version_actual]
+        if not particion['filas'] or not pendientes:
+            plan.append((particion, 'al_dia'))
+            continue
+
+        caja = box(*particion['bbox'])
+        accion = 'solo_version'
+        for version in pendientes:
+            if version not in areas:
+                capas_viejas = cargar_instantanea(version) if version else None
+                areas[version] = 'desconocida' if capas_viejas is None else area_afectada(capas_viejas, capas_actuales)
+            area = areas[version]
+            if isinstance(area, str) or (area is not None and area.intersects(caja)):
+                accion = 'reclasificar'
+                break
+        plan.append((particion, accion))
+    return plan
+
+
+def marcar_version(sheet, particion, version_actual, columna_version):
+    """Escribe la versión actual en todas las filas de la partición. False si la hoja no tiene la columna."""
+    import gspread
+    headers = sheet.row_values(1)
+    if columna_version not in headers:
+        return False
+    nro_col = headers.index(columna_version) + 1
+    filas = particion['filas']
+    sheet.batch_update([{
+        'range': f"{gspread.utils.rowcol_to_a1(2, nro_col)}:{gspread.utils.rowcol_to_a1(filas + 1, nro_col)}",
+        'values': [[version_actual]] * filas
+    }], value_input_option='USER_ENTERED')
+    particion['versiones'] = [version_actual]
+    return True
+
+
+def registrar_reclasificacion(particion, df, columna_version):
+    """Tras reclasificar una partición completa, sus estadísticas se recalculan desde cero."""
+    particion['versiones'] = []
+    particion['bbox'] = None
+    _actualizar_estadisticas(particion, df, len(df), columna_version)
@@ -0,0 +1,415 @@
+"""
+Planificador de pedidos a la API de Google Sheets
+=================================================
+
+Todo el tráfico a Sheets (open, worksheet, get_all_records, row_values,
+append_rows, update, clear, ...) pasa por acá: `planificar_cliente(client)`
+envuelve el cliente de gspread y los spreadsheets/hojas que devuelve.
+
+- Cuota compartida: cada pedido reserva un lugar en una ventana de 60 s
+  (lecturas y escrituras por separado) registrada en
+  `.estado_etl/cuota_sheets.json`, protegida con un lock de archivo. Así
+  varios procesos (corrida horaria, reclasificación, backfill) que apuntan
+  al mismo spreadsheet se reparten la misma cuota.
+- Ritmo adaptativo: ante un 429 se reduce a la mitad el ritmo permitido y se
+  pausa a todos los procesos con backoff exponencial; cada pedido exitoso lo
+  vuelve a subir de a poco.
+- Menos pedidos: los metadatos de cada spreadsheet se leen una sola vez
+  (todas sus hojas) y los encabezados de todas sus hojas se piden juntos
+  (`values_batch_get`) la primera vez que se necesita uno; quedan en caché
+  hasta que se escribe sobre la fila 1 (ver también `batch_get` en
+  validar_indice).
+- Escrituras agrupadas: dentro de `with agrupar_escrituras(client):` los
+  `update`/`batch_update` de valores de todas las hojas de un spreadsheet se
+  acumulan y salen juntos en un solo `values_batch_update`. El buffer se
+  envía antes de cualquier lectura, append o clear sobre ese spreadsheet, al
+  cambiar el value_input_option, al pasar KOBO_SHEETS_CELDAS_POR_PEDIDO
+  celdas, con `vaciar()` y al salir del bloque (si el bloque termina con una
+  excepción, lo acumulado se descarta). Fuera del bloque cada escritura sale
+  en el momento, así un checkpoint nunca queda marcado antes de escribir.
+
+Límites por minuto: KOBO_SHEETS_LECTURAS_MIN y KOBO_SHEETS_ESCRITURAS_MIN
+(60 por defecto, la cuota por usuario de Google). Reintentos ante 429/5xx:
+KOBO_SHEETS_REINTENTOS (6 por defecto).
+"""
+
+import json
+import os
+import random
+import time
+from contextlib import contextmanager
+
+import gspread
+
+from sincronizacion import ESTADO_DIR
+
+try:
+    import fcntl
+except ImportError:  # Windows: la cuota se lleva igual, sin lock entre procesos
+    fcntl = None
+
+RUTA_CUOTA = os.path.join(ESTADO_DIR, 'cuota_sheets.json')
+RUTA_LOCK_CUOTA = os.path.join(ESTADO_DIR, 'cuota_sheets.lock')
+
+LIMITES = {
+    'lecturas': int(os.environ.get("KOBO_SHEETS_LECTURAS_MIN", "60")),
+    'escrituras': int(os.environ.get("KOBO_SHEETS_ESCRITURAS_MIN", "60")),
+}
+REINTENTOS = int(os.environ.get("KOBO_SHEETS_REINTENTOS", "6"))
+CELDAS_POR_PEDIDO = int(os.environ.get("KOBO_SHEETS_CELDAS_POR_PEDIDO", "200000"))
+VENTANA = 60.0
+FACTOR_MINIMO = 0.1
+AUMENTO_FACTOR = 0.05
+ESPERA_MAXIMA = 64.0
+CODIGOS_REINTENTABLES = {429, 500, 502, 503}
+
+# Métodos de gspread que cuentan como lectura (el resto, como escritura)
+LECTURAS = {'open', 'open_by_key', 'worksheet', 'worksheets', 'row_values', 'col_values',
+            'batch_get', 'acell', 'cell', 'find', 'findall', 'fetch_sheet_metadata', 'values_get'}
+# No se reintentan ante errores 5xx: el pedido pudo haberse aplicado (ej. filas duplicadas)
+NO_IDEMPOTENTES = {'append_row', 'append_rows', 'insert_row', 'insert_rows', 'add_worksheet'}
+
+
+# --- CUOTA COMPARTIDA ---
+
+def _estado_vacio():
+    return {'lecturas': [], 'escrituras': [], 'factor': 1.0, 'pausa_hasta': 0.0, 'racha_429': 0}
+
+
+@contextmanager
+def _estado_compartido():
+    """Estado de cuota bajo lock exclusivo; se guarda al salir del bloque."""
+    os.makedirs(ESTADO_DIR, exist_ok=True)
+    with open(RUTA_LOCK_CUOTA, 'a+') as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            estado = _estado_vacio()
+            if os.path.exists(RUTA_CUOTA):
+                try:
+                    with open(RUTA_CUOTA, 'r', encoding='utf-8') as f:
+                        estado.update(json.load(f))
+                except (OSError, ValueError):
+                    pass
+            yield estado
+            tmp = f"{RUTA_CUOTA}.{os.getpid()}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(estado, f)
+            os.replace(tmp, RUTA_CUOTA)
+        finally:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def reservar_cupo(tipo):
+    """Espera hasta que haya lugar en la ventana de 60 s para un pedido de `tipo`."""
+    while True:
+        with _estado_compartido() as estado:
+            ahora = time.time()
+            ventana = [t for t in estado[tipo] if t > ahora - VENTANA]
+            estado[tipo] = ventana
+            permitidos = max(1, int(LIMITES[tipo] * estado['factor']))
+            if ahora < estado['pausa_hasta']:
+                espera = estado['pausa_hasta'] - ahora
+            elif len(ventana) < permitidos:
+                ventana.append(ahora)
+                return
+            else:
+                espera = ventana[len(ventana) - permitidos] + VENTANA - ahora
+        time.sleep(min(max(espera, 0.05), VENTANA))
+
+
+def _registrar_resultado(cuota_excedida):
+    """Disminución multiplicativa ante un 429, aumento aditivo ante cada éxito."""
+    with _estado_compartido() as estado:
+        if cuota_excedida:
+            estado['racha_429'] += 1
+            estado['factor'] = max(FACTOR_MINIMO, estado['factor'] / 2)
+            espera = min(ESPERA_MAXIMA, 2 ** estado['racha_429'] + random.random())
+            estado['pausa_hasta'] = max(estado['pausa_hasta'], time.time() + espera)
+            return espera
+        estado['racha_429'] = 0
+        estado['factor'] = min(1.0, estado['factor'] + AUMENTO_FACTOR)
+        return 0
+
+
+def _codigo_http(error):
+    codigo = getattr(error, 'code', None)
+    if codigo is None:
+        codigo = getattr(getattr(error, 'response', None), 'status_code', None)
+    return codigo
+
+
+def ejecutar(tipo, funcion, args=(), kwargs=None, idempotente=True):
+    """Ejecuta un pedido a Sheets respetando la cuota compartida, con reintentos."""
+    for intento in range(REINTENTOS + 1):
+        reservar_cupo(tipo)
+        try:
+            resultado = funcion(*args, **(kwargs or {}))
+        except gspread.exceptions.APIError as e:
+            codigo = _codigo_http(e)
+            reintentable = codigo == 429 or (idempotente and codigo in CODIGOS_REINTENTABLES)
+            if not reintentable or intento == REINTENTOS:
+                raise
+            if codigo == 429:
+                espera = _registrar_resultado(cuota_excedida=True)
+                print(f"   ⏳ Cuota de Sheets excedida (429): se baja el ritmo y se reintenta en {espera:.0f}s")
+            else:
+                espera = min(ESPERA_MAXIMA, 2 ** intento + random.random())
+                print(f"   ⏳ Error {codigo} de Sheets: reintento en {espera:.0f}s")
+                time.sleep(espera)
+            continue
+        _registrar_resultado(cuota_excedida=False)
+        return resultado
+
+
+# --- ENVOLTORIOS DE GSPREAD ---
+
+def _rango_hoja(titulo, rango):
+    """'Sheet4', 'A2:B3' → "'Sheet4'!A2:B3"."""
+    return "'{}'!{}".format(titulo.replace("'", "''"), rango)
+
+
+def _celdas(datos):
+    return sum(len(fila) for d in datos for fila in d['values'])
+
+
+def _envolver(resultado):
+    if isinstance(resultado, gspread.Worksheet):
+        return HojaPlanificada(resultado)
+    if isinstance(resultado, gspread.Spreadsheet):
+        return SpreadsheetPlanificado(resultado)
+    if isinstance(resultado, list) and resultado and isinstance(resultado[0], gspread.Worksheet):
+        return [HojaPlanificada(ws) for ws in resultado]
+    return resultado
+
+
+class _Planificado:
+    """Delegación al objeto de gspread: todo método pasa por `ejecutar`."""
+
+    def __init__(self, objeto):
+        self._objeto = objeto
+
+    def _antes_de_pedido(self):
+        """Hook antes de delegar un método: envía las escrituras acumuladas."""
+
+    def __getattr__(self, nombre):
+        if nombre.startswith('_'):
+            raise AttributeError(nombre)
+        atributo = getattr(self._objeto, nombre)
+        if not callable(atributo):
+            return atributo
+        tipo = 'lecturas' if nombre in LECTURAS or nombre.startswith('get') else 'escrituras'
+
+        def llamada(*args, **kwargs):
+            self._antes_de_pedido()
+            return _envolver(ejecutar(tipo, atributo, args, kwargs, idempotente=nombre not in NO_IDEMPOTENTES))
+        return llamada
+
+
+class ClientePlanificado(_Planificado):
+    """Cliente de gspread: cada spreadsheet se abre una sola vez por proceso."""
+
+    def __init__(self, objeto):
+        super().__init__(objeto)
+        self._abiertos = {}
+        self._agrupando = 0
+
+    def open(self, nombre):
+        if nombre not in self._abiertos:
+            self._abiertos[nombre] = SpreadsheetPlanificado(ejecutar('lecturas', self._objeto.open, (nombre,)), self)
+        return self._abiertos[nombre]
+
+    def vaciar(self):
+        """Envía las escrituras acumuladas de todos los spreadsheets abiertos."""
+        for spreadsheet in self._abiertos.values():
+            spreadsheet.vaciar()
+
+
+class SpreadsheetPlanificado(_Planificado):
+    """
+    Spreadsheet: los metadatos de todas las hojas se piden una sola vez y las
+    escrituras de valores de sus hojas se acumulan en un buffer propio.
+    """
+
+    def __init__(self, objeto, cliente=None):
+        super().__init__(objeto)
+        self._cliente = cliente
+        self._hojas = None
+        self._pendientes = []
+        self._opcion = None
+
+    def _antes_de_pedido(self):
+        self.vaciar()
+
+    def agrupando(self):
+        return bool(self._cliente and self._cliente._agrupando)
+
+    def encolar(self, titulo, datos, opcion):
+        """Acumula escrituras de valores de la hoja `titulo` ([{'range', 'values'}])."""
+        if self._pendientes and (opcion != self._opcion or _celdas(self._pendientes) + _celdas(datos) > CELDAS_POR_PEDIDO):
+            self.vaciar()
+        self._opcion = opcion
+        self._pendientes.extend({'range': _rango_hoja(titulo, d['range']), 'values': d['values']} for d in datos)
+
+    def vaciar(self):
+        """Envía el buffer en un solo values_batch_update."""
+        if not self._pendientes:
+            return
+        cuerpo = {'valueInputOption': self._opcion, 'data': self._pendientes}
+        try:
+            ejecutar('escrituras', self._objeto.values_batch_update, (cuerpo,))
+        finally:
+            self._pendientes = []
+
+    def descartar(self):
+        self._pendientes = []
+
+    def worksheets(self, *args, **kwargs):
+        if self._hojas is None:
+            hojas = ejecutar('lecturas', self._objeto.worksheets, args, kwargs)
+            self._hojas = {ws.title: HojaPlanificada(ws, self) for ws in hojas}
+        return list(self._hojas.values())
+
+    def worksheet(self, titulo):
+        self.worksheets()
+        if titulo not in self._hojas:
+            raise gspread.exceptions.WorksheetNotFound(titulo)
+        return self._hojas[titulo]
+
+    def add_worksheet(self, *args, **kwargs):
+        hoja = HojaPlanificada(ejecutar('escrituras', self._objeto.add_worksheet, args, kwargs, idempotente=False), self)
+        if self._hojas is not None:
+            self._hojas[hoja.title] = hoja
+        return hoja
+
+    def leer_encabezados(self):
+        """Fila 1 de todas las hojas sin encabezado en caché, en una sola lectura."""
+        self.vaciar()
+        hojas = [hoja for hoja in self.worksheets() if hoja._encabezado is None]
+        if not hojas:
+            return
+        respuesta = ejecutar('lecturas', self._objeto.values_batch_get, ([_rango_hoja(h.title, '1:1') for h in hojas],))
+        for hoja, rango in zip(hojas, respuesta.get('valueRanges', [])):
+            valores = rango.get('values') or [[]]
+            hoja._encabezado = [str(v) for v in valores[0]]
+
+
+@contextmanager
+def agrupar_escrituras(client):
+    """
+    Dentro del bloque, las escrituras de valores de cada spreadsheet se
+    acumulan y se envían juntas (ver el docstring del módulo). Sin
+    planificador (cliente de gspread directo) no hace nada.
+    """
+    if not isinstance(client, ClientePlanificado):
+        yield
+        return
+    client._agrupando += 1
+    try:
+        yield
+    except BaseException:
+        client._agrupando -= 1
+        if not client._agrupando:
+            for spreadsheet in client._abiertos.values():
+                spreadsheet.descartar()
+        raise
+    client._agrupando -= 1
+    if not client._agrupando:
+        client.vaciar()
+
+
+def _toca_encabezado(rango):
+    """True si el rango A1 puede incluir la fila 1."""
+    try:
+        return gspread.utils.a1_to_rowcol(rango.split('!')[-1].split(':')[0])[0] == 1
+    except Exception:
+        return True
+
+
+class HojaPlanificada(_Planificado):
+    """
+    Worksheet con el encabezado (fila 1) en caché hasta que se escribe sobre
+    él. Sus escrituras de valores pasan por el buffer de su spreadsheet.
+    """
+
+    def __init__(self, objeto, spreadsheet=None):
+        super().__init__(objeto)
+        self._spreadsheet = spreadsheet
+        self._encabezado = None
+
+    def _antes_de_pedido(self):
+        self.vaciar()
+
+    def _agrupa(self):
+        return self._spreadsheet is not None and self._spreadsheet.agrupando()
+
+    def vaciar(self):
+        if self._spreadsheet is not None:
+            self._spreadsheet.vaciar()
+
+    def row_values(self, fila, **kwargs):
+        if fila != 1 or kwargs:
+            self.vaciar()
+            return ejecutar('lecturas', self._objeto.row_values, (fila,), kwargs)
+        if self._encabezado is None:
+            if self._spreadsheet is not None:
+                self._spreadsheet.leer_encabezados()
+            if self._encabezado is None:
+                self.vaciar()
+                self._encabezado = ejecutar('lecturas', self._objeto.row_values, (1,))
+        return list(self._encabezado)
+
+    def batch_get(self, rangos, **kwargs):
+        self.vaciar()
+        resultado = ejecutar('lecturas', self._objeto.batch_get, (rangos,), kwargs)
+        if '1:1' in rangos and not kwargs:
+            filas = resultado[rangos.index('1:1')]
+            self._encabezado = list(filas[0]) if filas else []
+        return resultado
+
+    def clear(self):
+        self.vaciar()
+        resultado = ejecutar('escrituras', self._objeto.clear)
+        self._encabezado = []
+        return resultado
+
+    def update(self, *args, **kwargs):
+        rango, valores = kwargs.get('range_name'), kwargs.get('values')
+        if self._agrupa() and not args and valores is not None and set(kwargs) <= {'values', 'range_name', 'value_input_option'}:
+            self._spreadsheet.encolar(
+                self.title, [{'range': rango or 'A1', 'values': valores}], kwargs.get('value_input_option') or 'RAW'
+            )
+            resultado = None
+        else:
+            self.vaciar()
+            resultado = ejecutar('escrituras', self._objeto.update, args, kwargs)
+        if not args and rango in (None, 'A1') and valores:
+            self._encabezado = [str(v) for v in valores[0]]
+        elif args or rango is None or _toca_encabezado(rango):
+            self._encabezado = None
+        return resultado
+
+    def batch_update(self, datos, **kwargs):
+        if self._agrupa() and set(kwargs) <= {'value_input_option'}:
+            self._spreadsheet.encolar(self.title, datos, kwargs.get('value_input_option') or 'RAW')
+            resultado = None
+        else:
+            self.vaciar()
+            resultado = ejecutar('escrituras', self._objeto.batch_update, (datos,), kwargs)
+        if any(_toca_encabezado(d['range']) for d in datos):
+            self._encabezado = None
+        return resultado
+
+    def append_rows(self, *args, **kwargs):
+        self.vaciar()
+        resultado = ejecutar('escrituras', self._objeto.append_rows, args, kwargs, idempotente=False)
+        if not self._encabezado:
+            # Sobre una hoja vacía el append escribe la fila 1
+            self._encabezado = None
+        return resultado
+
+
+def planificar_cliente(client):
+    """Envuelve un cliente autorizado de gspread para que use el planificador."""
+    return ClientePlanificado(client)
@@ -15,6 +15,15 @@ Clasificación en 3 pasos:
 1. Palermo Norte → 14.5
 2. Anillo Digital C2 → 2.5
 3. Comunas → 1.0-15.0
+
+Reclasificación por versión de geometrías:
+Si el sheet ya tiene la columna `version_geometria`, por defecto sólo se
+reclasifican los puntos dentro del área que cambió entre la versión de cada
+fila y la actual (ver geometrias.py), y sólo se escriben esas celdas.
+Con `--completo` se reclasifica y reemplaza todo el historial.
+
+Con KOBO_HOJAS_PARTICIONADAS=1 se recorre cada partición del manifiesto
+(ver particiones_sheet.py) y sólo se descargan las que pueden cambiar.
 """
 
 import pandas as pd
@@ -27,9 +36,24 @@ import os
 import json
 import sys
 import re
-import zipfile
 from datetime import datetime
 
+from baja_memoria import (
+    BAJA_MEMORIA, compactar, iterar_lotes, lote_como_objetos, escribir_en_sheet
+)
+from sincronizacion import invalidar_indice, tabla_existe, merge_bigquery
+from clasificacion_paralela import usar_modo_paralelo, clasificar_en_paralelo
+from etapas import iniciar_corrida, ejecutar_etapa, finalizar_corrida
+from geometrias import (
+    POLIGONOS_RECORRIDO, COLUMNA_VERSION, buscar_columna_comuna, cargar_capas,
+    compilar_capas, guardar_instantanea, cargar_instantanea, area_afectada
+)
+from particiones_sheet import (
+    PARTICIONADO, cargar_manifiesto, guardar_manifiesto, particiones_a_reclasificar,
+    marcar_version, registrar_reclasificacion, hoja_indice
+)
+from planificador_sheets import agrupar_escrituras, planificar_cliente
+
 # Configuración Google Sheets
 NOMBRE_SPREADSHEET = "puntos flash"
 NOMBRE_HOJA = "Sheet4"
@@ -40,6 +64,8 @@ PROJECT_ID = 'kobo-looker-connect'
 DATASET_ID = 'datos_flash'
 TABLE_ID = 'kobo_flash_consolidado'
 CREDENTIALS_PATH = 'kobo-looker-connect.json'
+# Con el sheet particionado cada hoja tiene sólo una parte del historial: MERGE en vez de reemplazo
+MODO_BIGQUERY = 'upsert' if PARTICIONADO else 'replace'
 
 # Buscar archivos geográficos
 print("🔍 Buscando archivos geográficos...")
@@ -65,43 +91,19 @@ if not all([RUTA_KMZ_PALERMO, RUTA_KML_ANILLO_DIGITAL, RUTA_SHP_COMUNAS]):
     print("❌ ERROR: Faltan archivos geográficos")
     sys.exit(1)
 
-def clasificar_localizacion_3_pasos(df):
+def clasificar_localizacion_3_pasos(df, capas_gdf):
     """
     Aplica clasificación en 3 pasos a un DataFrame con columnas latitude/longitude
     """
     print("\n🗺️ Iniciando clasificación espacial en 3 pasos...")
     
-    # Cargar capas geográficas
-    print("📂 Cargando capas...")
+    if usar_modo_paralelo(len(df)):
+        # Reclasificación de todo el historial: pool de procesos por teselas
+        capas = compilar_capas(*capas_gdf, POLIGONOS_RECORRIDO)
+        df['Localizacion_Nueva'], df['Poligono_Nuevo'] = clasificar_en_paralelo(df.longitude, df.latitude, capas)
+        return df
     
-    # Palermo Norte
-    with zipfile.ZipFile(RUTA_KMZ_PALERMO, 'r') as kmz:
-        kml_files = [f for f in kmz.namelist() if f.endswith('.kml')]
-        if kml_files:
-            with kmz.open(kml_files[0]) as kml_file:
-                palermo_gdf = gpd.read_file(kml_file)
-    if palermo_gdf.crs is None:
-        palermo_gdf.set_crs("EPSG:4326", inplace=True)
-    palermo_gdf = palermo_gdf.to_crs("EPSG:4326")
-    
-    # Anillo Digital
-    try:
-        anillo_digital_gdf = gpd.read_file(RUTA_KML_ANILLO_DIGITAL)
-    except:
-        if RUTA_KML_ANILLO_DIGITAL.lower().endswith('.kmz'):
-            with zipfile.ZipFile(RUTA_KML_ANILLO_DIGITAL, 'r') as kmz:
-                kml_files = [f for f in kmz.namelist() if f.endswith('.kml')]
-                if kml_files:
-                    with kmz.open(kml_files[0]) as kml_file:
-                        anillo_digital_gdf = gpd.read_file(kml_file)
-        else:
-            anillo_digital_gdf = gpd.read_file(RUTA_KML_ANILLO_DIGITAL)
-    if anillo_digital_gdf.crs is None:
-        anillo_digital_gdf.set_crs("EPSG:4326", inplace=True)
-    anillo_digital_gdf = anillo_digital_gdf.to_crs("EPSG:4326")
-    
-    # Comunas
-    comunas_gdf = gpd.read_file(RUTA_SHP_COMUNAS).to_crs("EPSG:4326")
+    palermo_gdf, anillo_digital_gdf, comunas_gdf = capas_gdf
     
     # Convertir puntos a GeoDataFrame
     puntos_gdf = gpd.GeoDataFrame(
@@ -139,32 +141,73 @@ def clasificar_localizacion_3_pasos(df):
     if not puntos_para_comunas.empty:
         puntos_en_comunas = gpd.sjoin(puntos_para_comunas, comunas_gdf, how="inner", predicate='within')
         if not puntos_en_comunas.empty:
-            comuna_col = None
-            for col in ['comunas', 'COMUNAS', 'comuna', 'COMUNA', 'NAM', 'ID']:
-                if col in puntos_en_comunas.columns:
-                    comuna_col = col
-                    break
+            comuna_col = buscar_columna_comuna(puntos_en_comunas.columns)
             
             if comuna_col:
                 valores_numericos = pd.to_numeric(puntos_en_comunas[comuna_col], errors='coerce')
                 puntos_gdf.loc[puntos_en_comunas.index, 'Localizacion_Nueva'] = valores_numericos
                 print(f"      ✅ {len(puntos_en_comunas)} puntos → Comunas 1.0-15.0")
     
-    # Agregar nueva columna al DataFrame original
+    # Agregar nuevas columnas al DataFrame original
     df['Localizacion_Nueva'] = puntos_gdf['Localizacion_Nueva']
+    df['Poligono_Nuevo'] = ''
+    for nombre, poligono in POLIGONOS_RECORRIDO.items():
+        dentro = puntos_gdf.within(poligono)
+        if dentro.any():
+            df.loc[dentro, 'Poligono_Nuevo'] = nombre
     
     return df
 
-def subir_a_bigquery(df):
+def seleccionar_filas_afectadas(df, capas_actuales, version_actual):
+    """
+    Devuelve una máscara con las filas que deben reclasificarse.
+    - Filas ya marcadas con la versión actual → no se tocan.
+    - Filas de una versión con instantánea → sólo si caen en el área que cambió.
+    - Filas sin versión o con versión desconocida → se reclasifican siempre.
+    """
+    if COLUMNA_VERSION not in df.columns:
+        print("   ℹ️ El sheet no tiene columna de versión: se reclasifican todas las filas")
+        return pd.Series(True, index=df.index)
+    
+    versiones = df[COLUMNA_VERSION].fillna('').astype(str)
+    mascara = pd.Series(False, index=df.index)
+    
+    for version, filas in versiones.groupby(versiones).groups.items():
+        if version == version_actual:
+            print(f"   ✅ {len(filas)} filas ya están en la versión {version_actual}")
+            continue
+        
+        capas_viejas = cargar_instantanea(version) if version else None
+        if capas_viejas is None:
+            print(f"   ⚠️ Versión '{version or 'sin versión'}' sin instantánea: {len(filas)} filas se reclasifican completas")
+            mascara.loc[filas] = True
+            continue
+        
+        area = area_afectada(capas_viejas, capas_actuales)
+        if area is None:
+            print(f"   ✅ Versión {version}: geometrías equivalentes, {len(filas)} filas sin cambios")
+            continue
+        
+        sub = df.loc[filas]
+        puntos = gpd.GeoSeries(gpd.points_from_xy(sub.longitude, sub.latitude), index=sub.index, crs="EPSG:4326")
+        afectadas = puntos.intersects(area)
+        mascara.loc[afectadas[afectadas].index] = True
+        print(f"   🔹 Versión {version}: {int(afectadas.sum())} de {len(filas)} filas en el área modificada")
+    
+    return mascara
+
+def subir_a_bigquery(df, modo='replace', id_corrida=None):
     """
     Sube el DataFrame a Google BigQuery.
     Trabaja sobre una copia para no afectar los datos de Sheets.
     Limpia nombres de columnas y sanitiza tipos para compatibilidad con BigQuery.
+    Con modo='upsert' (sheet particionado: cada partición es sólo una parte
+    del historial) carga a una tabla staging y hace MERGE por uuid.
     """
     print("\n🔄 Preparando datos para BigQuery...")
     
-    # 1. Clonar DataFrame
-    df_bq = df.copy()
+    # 1. Clonar DataFrame (en modo baja memoria sólo se renombran columnas)
+    df_bq = df.copy(deep=not BAJA_MEMORIA)
     
     # 2. Limpieza de nombres de columnas para BigQuery
     def limpiar_nombre_columna(nombre):
@@ -181,11 +224,13 @@ def subir_a_bigquery(df):
     print(f"   ✅ Nombres de columnas limpiados para BigQuery")
     
     # 3. Sanitización de tipos complejos (listas/diccionarios)
-    for col in df_bq.columns:
-        df_bq[col] = df_bq[col].apply(
-            lambda x: str(x) if isinstance(x, (list, dict)) else x
-        )
-    print(f"   ✅ Tipos de datos sanitizados")
+    # En modo baja memoria se hace al serializar cada lote
+    if not BAJA_MEMORIA:
+        for col in df_bq.columns:
+            df_bq[col] = df_bq[col].apply(
+                lambda x: str(x) if isinstance(x, (list, dict)) else x
+            )
+        print(f"   ✅ Tipos de datos sanitizados")
     
     # 4. Buscar archivo de credenciales
     possible_names = ['kobo-looker-connect.json', 'credenciales.json', 'service_account.json']
@@ -210,21 +255,194 @@ def subir_a_bigquery(df):
         scopes=["https://www.googleapis.com/auth/bigquery"]
     )
     
-    # 6. Carga a BigQuery
+    # 6. Carga a BigQuery (en upsert, primero a la tabla staging)
     table_full_id = f"{DATASET_ID}.{TABLE_ID}"
+    hacer_merge = False
+    if modo == 'upsert':
+        from google.cloud import bigquery
+        bq_client = bigquery.Client(project=PROJECT_ID, credentials=credentials)
+        if tabla_existe(bq_client, f"{PROJECT_ID}.{table_full_id}"):
+            table_full_id = f"{DATASET_ID}.{TABLE_ID}_staging_{id_corrida or 'manual'}"
+            hacer_merge = True
     print(f"   📤 Subiendo a BigQuery: {PROJECT_ID}.{table_full_id}")
     
-    df_bq.to_gbq(
-        destination_table=table_full_id,
-        project_id=PROJECT_ID,
-        credentials=credentials,
-        if_exists='replace',
-        progress_bar=False
-    )
+    if not BAJA_MEMORIA:
+        df_bq.to_gbq(
+            destination_table=table_full_id,
+            project_id=PROJECT_ID,
+            credentials=credentials,
+            if_exists='replace',
+            progress_bar=False
+        )
+    else:
+        # Modo baja memoria: se expande a objetos Python lote por lote
+        for inicio, lote in iterar_lotes(df_bq):
+            lote_como_objetos(lote).to_gbq(
+                destination_table=table_full_id,
+                project_id=PROJECT_ID,
+                credentials=credentials,
+                if_exists='replace' if inicio == 0 else 'append',
+                progress_bar=False
+            )
+    
+    if hacer_merge:
+        print(f"   🔀 MERGE por uuid en {PROJECT_ID}.{DATASET_ID}.{TABLE_ID}")
+        merge_bigquery(bq_client, f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}", f"{PROJECT_ID}.{table_full_id}")
     
     print(f"   ✅ {len(df_bq)} registros cargados exitosamente a BigQuery")
 
+def calcular_cambios_por_version(df, headers, capas_gdf, capas_actuales, version_actual):
+    """
+    Reclasificación acotada al cambio de geometrías: sólo se recalculan las
+    filas dentro del área afectada. Devuelve (cambios para batch_update,
+    df actualizado, cantidad de filas reclasificadas).
+    """
+    df['latitude'] = pd.to_numeric(df['latitude'], errors='coerce')
+    df['longitude'] = pd.to_numeric(df['longitude'], errors='coerce')
+    df_con_coords = df.dropna(subset=['latitude', 'longitude'])
+    print(f"📍 Registros con coordenadas válidas: {len(df_con_coords)}")
+    
+    print("\n🔎 Buscando filas afectadas por el cambio de geometrías...")
+    mascara = seleccionar_filas_afectadas(df_con_coords, capas_actuales, version_actual)
+    df_afectadas = df_con_coords[mascara].copy()
+    print(f"   📌 Filas a reclasificar: {len(df_afectadas)} de {len(df)}")
+    
+    cambios = []
+    if not df_afectadas.empty:
+        df_afectadas = clasificar_localizacion_3_pasos(df_afectadas, capas_gdf)
+        
+        columnas = [('Localizacion', 'Localizacion_Nueva'), ('Poligono', 'Poligono_Nuevo')]
+        for col_sheet, col_nueva in columnas:
+            nro_col = headers.index(col_sheet) + 1
+            for idx, fila in df_afectadas.iterrows():
+                valor_nuevo = fila[col_nueva]
+                valor_nuevo = None if valor_nuevo == '' or pd.isnull(valor_nuevo) else valor_nuevo
+                valor_viejo = df.at[idx, col_sheet]
+                valor_viejo = None if valor_viejo == '' or pd.isnull(valor_viejo) else valor_viejo
+                if valor_nuevo != valor_viejo:
+                    # idx 0 corresponde a la fila 2 del sheet (la 1 es el encabezado)
+                    cambios.append({
+                        'range': gspread.utils.rowcol_to_a1(idx + 2, nro_col),
+                        'values': [[valor_nuevo if valor_nuevo is not None else '']]
+                    })
+                    df.at[idx, col_sheet] = valor_nuevo
+    
+    print(f"   ✏️ Celdas de clasificación que cambian: {len(cambios)}")
+    
+    # Toda fila fuera del área afectada clasifica igual en la nueva versión
+    nro_col_version = headers.index(COLUMNA_VERSION) + 1
+    cambios.append({
+        'range': f"{gspread.utils.rowcol_to_a1(2, nro_col_version)}:{gspread.utils.rowcol_to_a1(len(df) + 1, nro_col_version)}",
+        'values': [[version_actual]] * len(df)
+    })
+    df[COLUMNA_VERSION] = version_actual
+    
+    return cambios, df, len(df_afectadas)
+
+def reclasificar_por_version(corrida, sheet, df, capas_gdf, capas_actuales, version_actual, backup_file):
+    """
+    Aplica la reclasificación por versión: sólo se escriben las celdas que
+    cambian (más la columna de versión). Cada paso queda con checkpoint.
+    Devuelve el DataFrame reclasificado, o None si BigQuery quedó pendiente.
+    """
+    headers = sheet.row_values(1)
+    for col in ['Localizacion', 'Poligono', COLUMNA_VERSION]:
+        if col not in headers:
+            print(f"❌ ERROR: El sheet no tiene la columna '{col}'. Ejecutar con --completo")
+            sys.exit(1)
+    
+    cambios, df, cantidad_afectadas = ejecutar_etapa(
+        corrida, 'clasificacion',
+        lambda: calcular_cambios_por_version(df, headers, capas_gdf, capas_actuales, version_actual)
+    )
+    
+    respuesta_final = input("¿Confirmas la actualización del sheet? (escribe 'SI'): ")
+    if respuesta_final.upper() != 'SI':
+        # Cerrar la corrida: retomarla más tarde escribiría una descarga ya vieja
+        finalizar_corrida(corrida)
+        print("❌ Operación cancelada")
+        sys.exit(0)
+    
+    # batch_update sobre rangos fijos: reintentarlo deja el mismo resultado
+    ejecutar_etapa(corrida, 'carga_sheets', lambda: sheet.batch_update(cambios, value_input_option='USER_ENTERED'))
+    
+    # Subir a BigQuery
+    print("\n📤 Subiendo a BigQuery...")
+    if BAJA_MEMORIA:
+        df_final = compactar(df.reindex(columns=headers))
+    else:
+        df_final = df.reindex(columns=headers).astype(object)
+        df_final = df_final.where(pd.notnull(df_final), None)
+    try:
+        ejecutar_etapa(corrida, 'carga_bigquery', lambda: subir_a_bigquery(df_final, MODO_BIGQUERY, corrida['id']))
+        print("   ✅ Carga a BigQuery exitosa")
+    except Exception as e:
+        print(f"   ⚠️  Error en BigQuery (no crítico): {e}")
+        print(f"   ℹ️  Los datos en Google Sheets se actualizaron correctamente")
+        print(f"   ℹ️  Al reejecutar se retoma la corrida {corrida['id']} desde esta etapa")
+        return None
+    
+    finalizar_corrida(corrida)
+    print("\n" + "="*60)
+    print("✅ RECLASIFICACIÓN POR VERSIÓN COMPLETADA")
+    print("="*60)
+    print(f"📁 Backup guardado en: {backup_file}")
+    print(f"📊 Filas reclasificadas: {cantidad_afectadas} de {len(df)}")
+    print(f"🏷️ Versión de geometrías: {version_actual}")
+    return df
+
+def reclasificar_completo(df, capas_gdf, version_actual):
+    """Reclasifica todas las filas con coordenadas (modo --completo)."""
+    # Eliminar filas sin coordenadas válidas
+    df_con_coords = df.dropna(subset=['latitude', 'longitude']).copy()
+    print(f"📍 Registros con coordenadas válidas: {len(df_con_coords)}")
+    
+    # Aplicar reclasificación
+    df_reclasificado = clasificar_localizacion_3_pasos(df_con_coords, capas_gdf)
+    
+    # Mostrar estadísticas
+    print("\n📊 Resultados de reclasificación:")
+    print(f"   • Palermo Norte (14.5): {(df_reclasificado['Localizacion_Nueva'] == 14.5).sum()}")
+    print(f"   • Anillo Digital C2 (2.5): {(df_reclasificado['Localizacion_Nueva'] == 2.5).sum()}")
+    print(f"   • Comuna 1-15: {((df_reclasificado['Localizacion_Nueva'] >= 1) & (df_reclasificado['Localizacion_Nueva'] <= 15)).sum()}")
+    print(f"   • Sin clasificar: {df_reclasificado['Localizacion_Nueva'].isna().sum()}")
+    
+    # Reemplazar columna Localizacion con Localizacion_Nueva
+    if 'Localizacion' in df_reclasificado.columns:
+        df_reclasificado['Localizacion'] = df_reclasificado['Localizacion_Nueva']
+        df_reclasificado = df_reclasificado.drop(columns=['Localizacion_Nueva'])
+    else:
+        df_reclasificado = df_reclasificado.rename(columns={'Localizacion_Nueva': 'Localizacion'})
+    df_reclasificado['Poligono'] = df_reclasificado.pop('Poligono_Nuevo')
+    df_reclasificado[COLUMNA_VERSION] = version_actual
+    
+    if BAJA_MEMORIA:
+        # Tipos compactos: la expansión a objetos Python se hace lote por lote al subir
+        df_final = compactar(df_reclasificado)
+    else:
+        # Convertir a object y reemplazar NaN con None para Google Sheets
+        df_final = df_reclasificado.astype(object)
+        df_final = df_final.where(pd.notnull(df_final), None)
+    
+    return df_final
+
+def reemplazar_sheet(sheet, df_final, nombre_indice=None):
+    """Reemplaza todo el contenido del sheet con df_final."""
+    if BAJA_MEMORIA:
+        escribir_en_sheet(sheet, df_final, reemplazar=True)
+    else:
+        sheet.clear()
+        sheet.update(
+            values=[df_final.columns.values.tolist()] + df_final.values.tolist(),
+            value_input_option='USER_ENTERED'
+        )
+    # Las filas cambiaron de posición y contenido: el índice _uuid → fila ya no sirve
+    invalidar_indice(nombre_indice)
+
 def main():
+    # --completo fuerza la reclasificación de todo el historial (comportamiento original)
+    modo_completo = '--completo' in sys.argv[1:]
+    
     print("="*60)
     print("🔄 SCRIPT DE RECLASIFICACIÓN ÚNICA - GOOGLE SHEETS")
     print("="*60)
@@ -237,6 +455,9 @@ def main():
     print("   • Palermo Norte → 14.5")
     print("   • Anillo Digital C2 → 2.5")
     print("   • Comunas → 1.0-15.0")
+    if not modo_completo:
+        print("\nℹ️ Modo por versión: sólo se reclasifican los puntos en el área que cambió")
+        print("   (usar --completo para reclasificar todo el historial)")
     
     respuesta = input("\n¿Continuar? (escribe 'SI' para confirmar): ")
     if respuesta.upper() != 'SI':
@@ -276,23 +497,76 @@ def main():
         
         creds = ServiceAccountCredentials.from_json_keyfile_name(ruta_creds, scope)
     
-    client = gspread.authorize(creds)
-    sheet = client.open(NOMBRE_SPREADSHEET).worksheet(NOMBRE_HOJA)
+    # Capas geográficas y versión actual
+    capas_gdf = cargar_capas(RUTA_KMZ_PALERMO, RUTA_KML_ANILLO_DIGITAL, RUTA_SHP_COMUNAS)
+    capas_actuales = compilar_capas(*capas_gdf, POLIGONOS_RECORRIDO)
+    version_actual = guardar_instantanea(capas_actuales)
+    print(f"🏷️ Versión actual de geometrías: {version_actual}")
+    
+    client = planificar_cliente(gspread.authorize(creds))
+    nombre_corrida = 'reclassify_sheet_once_completo' if modo_completo else 'reclassify_sheet_once'
+    
+    if not PARTICIONADO:
+        sheet = client.open(NOMBRE_SPREADSHEET).worksheet(NOMBRE_HOJA)
+        reclasificar_hoja(sheet, nombre_corrida, modo_completo, capas_gdf, capas_actuales, version_actual)
+        return
+    
+    # Sheet particionado: sólo se descargan las particiones que pueden cambiar
+    manifiesto = cargar_manifiesto(client, NOMBRE_SPREADSHEET, NOMBRE_HOJA)
+    plan = particiones_a_reclasificar(manifiesto, capas_actuales, version_actual, modo_completo)
+    
+    # Primero las que sólo necesitan la columna de versión: todas esas
+    # escrituras (y el manifiesto) salen juntas por spreadsheet
+    a_reclasificar = []
+    with agrupar_escrituras(client):
+        for particion, accion in plan:
+            print(f"\n📄 Partición {particion['hoja']} ({particion['filas']} filas): {accion}")
+            if accion == 'al_dia':
+                continue
+            sheet = client.open(particion['spreadsheet']).worksheet(particion['hoja'])
+            if accion == 'solo_version' and marcar_version(sheet, particion, version_actual, COLUMNA_VERSION):
+                print(f"   ✅ Fuera del área modificada: sólo se marcó la versión {version_actual}")
+            else:
+                a_reclasificar.append((particion, sheet))
+        guardar_manifiesto(client, manifiesto)
+    
+    # Las que se descargan y reclasifican, una por una (cada una con su corrida y checkpoints)
+    for particion, sheet in a_reclasificar:
+        print(f"\n📄 Reclasificando partición {particion['hoja']}")
+        df_final = reclasificar_hoja(
+            sheet, f"{nombre_corrida}_{particion['hoja']}", modo_completo, capas_gdf,
+            capas_actuales, version_actual, hoja_indice(particion, NOMBRE_HOJA)
+        )
+        if df_final is None:
+            continue
+        registrar_reclasificacion(particion, df_final, COLUMNA_VERSION)
+        guardar_manifiesto(client, manifiesto)
+
+def reclasificar_hoja(sheet, nombre_corrida, modo_completo, capas_gdf, capas_actuales, version_actual, nombre_indice=None):
+    """
+    Reclasifica una hoja (el sheet completo o una partición). Devuelve el
+    DataFrame reclasificado, o None si la corrida quedó pendiente.
+    """
+    # Si una ejecución anterior falló, se retoma su corrida (ej. sin volver a
+    # descargar un sheet que quedó a medio reemplazar)
+    corrida = iniciar_corrida(nombre_corrida)
     
     # Descargar todos los datos
     print("⬇️ Descargando datos del sheet...")
-    registros = sheet.get_all_records()
+    df = ejecutar_etapa(corrida, 'extraccion', lambda: pd.DataFrame(sheet.get_all_records()))
     
-    if not registros:
+    if df.empty:
         print("❌ El sheet está vacío, no hay nada que reclasificar")
+        finalizar_corrida(corrida)
+        if PARTICIONADO:
+            return df
         sys.exit(1)
     
-    df = pd.DataFrame(registros)
     print(f"   ✅ Descargados {len(df)} registros")
     
     # Hacer backup
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    backup_file = f"backup_sheet_{timestamp}.csv"
+    backup_file = f"backup_{sheet.title}_{timestamp}.csv" if PARTICIONADO else f"backup_sheet_{timestamp}.csv"
     df.to_csv(backup_file, index=False)
     print(f"💾 Backup guardado: {backup_file}")
     
@@ -307,52 +581,35 @@ def main():
         print("❌ ERROR: No se encontraron columnas latitude/longitude")
         sys.exit(1)
     
-    # Eliminar filas sin coordenadas válidas
-    df_con_coords = df.dropna(subset=['latitude', 'longitude']).copy()
-    print(f"📍 Registros con coordenadas válidas: {len(df_con_coords)}")
+    if not modo_completo and COLUMNA_VERSION in df.columns:
+        return reclasificar_por_version(corrida, sheet, df, capas_gdf, capas_actuales, version_actual, backup_file)
     
-    # Aplicar reclasificación
-    df_reclasificado = clasificar_localizacion_3_pasos(df_con_coords)
-    
-    # Mostrar estadísticas
-    print("\n📊 Resultados de reclasificación:")
-    print(f"   • Palermo Norte (14.5): {(df_reclasificado['Localizacion_Nueva'] == 14.5).sum()}")
-    print(f"   • Anillo Digital C2 (2.5): {(df_reclasificado['Localizacion_Nueva'] == 2.5).sum()}")
-    print(f"   • Comuna 1-15: {((df_reclasificado['Localizacion_Nueva'] >= 1) & (df_reclasificado['Localizacion_Nueva'] <= 15)).sum()}")
-    print(f"   • Sin clasificar: {df_reclasificado['Localizacion_Nueva'].isna().sum()}")
-    
-    # Reemplazar columna Localizacion con Localizacion_Nueva
-    if 'Localizacion' in df_reclasificado.columns:
-        df_reclasificado['Localizacion'] = df_reclasificado['Localizacion_Nueva']
-        df_reclasificado = df_reclasificado.drop(columns=['Localizacion_Nueva'])
-    else:
-        df_reclasificado = df_reclasificado.rename(columns={'Localizacion_Nueva': 'Localizacion'})
-    
-    # Convertir a object y reemplazar NaN con None para Google Sheets
-    df_final = df_reclasificado.astype(object)
-    df_final = df_final.where(pd.notnull(df_final), None)
+    df_final = ejecutar_etapa(corrida, 'clasificacion', lambda: reclasificar_completo(df, capas_gdf, version_actual))
     
     # Subir a Google Sheets
     print("\n⬆️ Subiendo datos reclasificados al sheet...")
     respuesta_final = input("¿Confirmas el reemplazo del sheet? (escribe 'SI'): ")
     if respuesta_final.upper() != 'SI':
+        # Cerrar la corrida: retomarla más tarde escribiría una descarga ya vieja
+        finalizar_corrida(corrida)
         print("❌ Operación cancelada")
         sys.exit(0)
     
-    sheet.clear()
-    sheet.update(
-        values=[df_final.columns.values.tolist()] + df_final.values.tolist(),
-        value_input_option='USER_ENTERED'
-    )
+    # Reemplazo completo: reintentarlo deja el mismo resultado
+    ejecutar_etapa(corrida, 'carga_sheets', lambda: reemplazar_sheet(sheet, df_final, nombre_indice))
     
     # Subir a BigQuery
     print("\n📤 Subiendo a BigQuery...")
     try:
-        subir_a_bigquery(df_final)
+        ejecutar_etapa(corrida, 'carga_bigquery', lambda: subir_a_bigquery(df_final, MODO_BIGQUERY, corrida['id']))
         print("   ✅ Carga a BigQuery exitosa")
     except Exception as e:
         print(f"   ⚠️  Error en BigQuery (no crítico): {e}")
         print(f"   ℹ️  Los datos en Google Sheets se actualizaron correctamente")
+        print(f"   ℹ️  Al reejecutar se retoma la corrida {corrida['id']} desde esta etapa")
+        return None
+    
+    finalizar_corrida(corrida)
     
     print("\n" + "="*60)
     print("✅ RECLASIFICACIÓN COMPLETADA EXITOSAMENTE")
@@ -361,6 +618,7 @@ def main():
     print(f"📊 Total registros procesados: {len(df_final)}")
     print(f"📊 Tabla BigQuery: {PROJECT_ID}.{DATASET_ID}.{TABLE_ID}")
     print("\n🎉 El Google Sheet y BigQuery han sido actualizados con la nueva clasificación")
+    return df_final
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,376 @@
+"""
+Sincronización incremental con upsert
+=====================================
+
+Mantiene un índice local `_uuid` → fila del sheet (con un hash del contenido
+de cada fila) y una marca de agua (watermark) de la última descarga de Kobo.
+
+En cada corrida:
+1. Se piden a Kobo sólo los envíos nuevos o modificados desde la marca de agua.
+2. Las filas cuyo `_uuid` ya está en el sheet y cambiaron de contenido
+   (ej. `_validation_status`, `_notes`, conteos corregidos) se reescriben con
+   `batch_update` en su rango exacto; las nuevas se agregan con `append_rows`.
+3. En BigQuery se hace MERGE por `uuid` desde una tabla staging.
+
+El índice se guarda en KOBO_ESTADO_DIR (por defecto `.estado_etl/`).
+Con KOBO_SINCRONIZACION_COMPLETA=1 se ignora la marca de agua y se descarga
+la base completa (recomendado de vez en cuando para captar ediciones que Kobo
+no refleje en los campos de fecha).
+"""
+
+import hashlib
+import json
+import os
+import re
+from datetime import datetime, timezone
+
+import gspread
+import pandas as pd
+import requests
+
+from baja_memoria import iterar_lotes, serializar_lote
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ESTADO_DIR = os.environ.get("KOBO_ESTADO_DIR", os.path.join(BASE_DIR, '.estado_etl'))
+RUTA_INDICE = os.path.join(ESTADO_DIR, 'indice_uuid.json')
+RUTA_COLA_BIGQUERY = os.path.join(ESTADO_DIR, 'cola_bigquery.pkl')
+
+SINCRONIZACION_COMPLETA = os.environ.get("KOBO_SINCRONIZACION_COMPLETA", "").lower() in ('1', 'true', 'si', 'sí')
+# Tope de la cola de BigQuery: pasado cualquiera de los dos se descarta lo pendiente
+COLA_BIGQUERY_MAX_FILAS = int(os.environ.get("KOBO_COLA_BIGQUERY_MAX_FILAS", "50000"))
+COLA_BIGQUERY_MAX_DIAS = float(os.environ.get("KOBO_COLA_BIGQUERY_MAX_DIAS", "7"))
+
+# Tipos de BigQuery (nombres legacy del schema) → tipos para CAST en SQL estándar
+TIPOS_SQL = {'FLOAT': 'FLOAT64', 'INTEGER': 'INT64', 'BOOLEAN': 'BOOL', 'RECORD': 'STRUCT'}
+
+
+# --- ÍNDICE LOCAL ---
+
+def ruta_indice(hoja=None):
+    """Índice principal, o el de una partición del sheet (ver particiones_sheet.py)."""
+    if hoja is None:
+        return RUTA_INDICE
+    return os.path.join(ESTADO_DIR, f"indice_uuid__{re.sub(r'[^A-Za-z0-9_-]', '_', hoja)}.json")
+
+
+def cargar_indice(hoja=None):
+    """Lee el índice local. Si no existe devuelve uno vacío."""
+    ruta = ruta_indice(hoja)
+    if os.path.exists(ruta):
+        try:
+            with open(ruta, 'r', encoding='utf-8') as f:
+                indice = json.load(f)
+            indice.setdefault('watermark', None)
+            indice.setdefault('filas', {})
+            return indice
+        except (OSError, ValueError) as e:
+            print(f"   ⚠️ Índice local ilegible, se reconstruye: {e}")
+    return {'watermark': None, 'filas': {}, 'nuevo': True}
+
+
+def guardar_indice(indice, hoja=None):
+    """Escritura atómica del índice (archivo temporal + replace)."""
+    os.makedirs(ESTADO_DIR, exist_ok=True)
+    indice = {k: v for k, v in indice.items() if k != 'nuevo'}
+    ruta = ruta_indice(hoja)
+    tmp = ruta + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(indice, f)
+    os.replace(tmp, ruta)
+
+
+def invalidar_indice(hoja=None):
+    """Borra el índice local (ej. tras reemplazar el sheet completo) para forzar su reconstrucción."""
+    ruta = ruta_indice(hoja)
+    if os.path.exists(ruta):
+        os.remove(ruta)
+        print("   🗑️ Índice _uuid local invalidado: se reconstruirá en la próxima corrida")
+
+
+def normalizar_valor(valor):
+    """Representación estable de una celda para el hash (None == '', 3.0 == 3)."""
+    if valor is None:
+        return ''
+    if isinstance(valor, float) and valor.is_integer():
+        return str(int(valor))
+    return str(valor)
+
+
+def hash_fila(valores):
+    return hashlib.sha1(
+        json.dumps([normalizar_valor(v) for v in valores], ensure_ascii=False).encode('utf-8')
+    ).hexdigest()[:16]
+
+
+def _letra_columna(nro_col):
+    return gspread.utils.rowcol_to_a1(1, nro_col)[:-1]
+
+
+def _leer_encabezado_y_uuids(sheet, indice):
+    """
+    Encabezado y valores de la columna _uuid. Si el índice recuerda en qué
+    columna está _uuid, ambos se piden en una sola lectura (batch_get).
+    """
+    letra = indice.get('columna_uuid')
+    if letra:
+        encabezado, columna = sheet.batch_get(['1:1', f"{letra}2:{letra}"])
+        encabezado = list(encabezado[0]) if encabezado else []
+        if '_uuid' in encabezado and _letra_columna(encabezado.index('_uuid') + 1) == letra:
+            return encabezado, [fila[0] if fila else '' for fila in columna]
+    else:
+        encabezado = sheet.row_values(1)
+    if '_uuid' not in encabezado:
+        return encabezado, None
+    return encabezado, sheet.col_values(encabezado.index('_uuid') + 1)[1:]
+
+
+def validar_indice(sheet, indice):
+    """
+    Compara el índice con la columna _uuid del sheet (una sola lectura de columna).
+    - Sin índice local: se reconstruye desde la columna _uuid, con los hashes
+      en None (desconocidos).
+    - Con índice desfasado (filas movidas/borradas a mano): se recalculan los
+      números de fila conservando los hashes conocidos.
+
+    Los hashes no se calculan desde el sheet: get_all_values devuelve los
+    valores formateados (fechas, horas, decimales según la configuración
+    regional, formatos numéricos), que no coinciden con los valores de Python
+    que hashea sincronizar_sheet, y la primera corrida reescribiría todo el
+    sheet. Con hash desconocido, sincronizar_sheet toma el de la descarga sin
+    escribir. Contra: si un envío se editó en Kobo mientras faltaba el índice
+    y el sheet quedó con la versión vieja, recién se reescribe cuando vuelva a
+    cambiar (o con reclassify_sheet_once.py --completo).
+    """
+    if indice.get('nuevo'):
+        encabezado = sheet.row_values(1)
+        if '_uuid' not in encabezado:
+            return {'watermark': None, 'filas': {}}
+        print("   🔨 Reconstruyendo índice _uuid → fila desde el sheet...")
+        col_uuid = encabezado.index('_uuid')
+        uuids = sheet.col_values(col_uuid + 1)[1:]
+        filas = {u: [nro_fila, None] for nro_fila, u in enumerate(uuids, start=2) if u}
+        print(f"   ✅ Índice reconstruido: {len(filas)} filas (hashes a tomar de la próxima descarga)")
+        return {'watermark': None, 'filas': filas, 'columna_uuid': _letra_columna(col_uuid + 1)}
+
+    encabezado, uuids = _leer_encabezado_y_uuids(sheet, indice)
+    if uuids is None:
+        return {'watermark': None, 'filas': {}}
+    indice['columna_uuid'] = _letra_columna(encabezado.index('_uuid') + 1)
+    filas = indice['filas']
+    desfasado = len(uuids) != len(filas) or any(v[0] is None for v in filas.values()) or any(
+        filas.get(u, [None])[0] != nro_fila for nro_fila, u in enumerate(uuids[-10:], start=len(uuids) - min(len(uuids), 10) + 2)
+    )
+    if desfasado:
+        print("   ⚠️ Índice local desfasado respecto del sheet: se recalculan las filas")
+        indice['filas'] = {
+            u: [nro_fila, filas.get(u, [None, None])[1]]
+            for nro_fila, u in enumerate(uuids, start=2) if u
+        }
+    return indice
+
+
+# --- KOBO ---
+
+def consultar_kobo(url, headers, watermark=None, rango=None):
+    """
+    Descarga envíos de Kobo siguiendo la paginación. Con watermark sólo pide
+    los envíos recibidos, editados o validados después de esa fecha; con
+    rango=(desde, hasta) sólo los de _submission_time en [desde, hasta).
+    """
+    params = {}
+    if rango:
+        params['query'] = json.dumps({'_submission_time': {'$gte': rango[0], '$lt': rango[1]}})
+    elif watermark:
+        epoch = int(datetime.fromisoformat(watermark).replace(tzinfo=timezone.utc).timestamp())
+        params['query'] = json.dumps({'$or': [
+            {'_submission_time': {'$gt': watermark}},
+            {'_last_edited': {'$gt': watermark}},
+            {'_validation_status.timestamp': {'$gt': epoch}},
+        ]})
+        print(f"   🔎 Pidiendo envíos nuevos o modificados desde {watermark}")
+
+    resultados = []
+    siguiente = url
+    while siguiente:
+        resp = requests.get(siguiente, headers=headers, params=params)
+        resp.raise_for_status()
+        datos = resp.json()
+        resultados.extend(datos.get('results', []))
+        siguiente = datos.get('next')
+        params = {}  # La URL 'next' ya incluye la consulta
+    return pd.json_normalize(resultados)
+
+
+def calcular_watermark(df_raw, anterior=None):
+    """Mayor fecha de envío/edición vista en la descarga (hora del servidor de Kobo)."""
+    candidatos = [anterior] if anterior else []
+    for col in ['_submission_time', '_last_edited']:
+        if col in df_raw.columns:
+            valores = df_raw[col].dropna().astype(str)
+            if not valores.empty:
+                candidatos.append(valores.max())
+    return max(candidatos) if candidatos else None
+
+
+# --- GOOGLE SHEETS ---
+
+def _fila_inicial(respuesta_append):
+    """Fila donde empezó un append_rows (ej. 'Sheet4!A120:AF130' → 120)."""
+    rango = respuesta_append.get('updates', {}).get('updatedRange', '')
+    match = re.search(r'!\$?[A-Z]+\$?(\d+)', rango)
+    return int(match.group(1)) if match else None
+
+
+def _vaciar_escrituras(sheet):
+    """Con el planificador las escrituras pueden quedar agrupadas: se envían antes de guardar el índice."""
+    vaciar = getattr(sheet, 'vaciar', None)
+    if vaciar:
+        vaciar()
+
+
+def sincronizar_sheet(sheet, df_final, headers_sheet, indice, al_terminar_lote=None):
+    """
+    Aplica el upsert lote por lote. Devuelve el conjunto de _uuid escritos
+    (nuevos o modificados), para replicar sólo esos en BigQuery.
+    Las filas con hash desconocido (índice reconstruido) no se escriben: se
+    guarda el hash de esta descarga (ver validar_indice).
+    `al_terminar_lote(indice)` permite persistir el índice tras cada lote.
+    """
+    col_uuid = headers_sheet.index('_uuid')
+    ultima_col = len(headers_sheet)
+    escritos = set()
+    total_nuevos = total_actualizados = total_sembrados = 0
+
+    for _, lote in iterar_lotes(df_final.reindex(columns=headers_sheet)):
+        actualizaciones, nuevos = [], []
+        sembrados = 0
+        for valores in serializar_lote(lote):
+            uuid = str(valores[col_uuid])
+            h = hash_fila(valores)
+            if uuid in indice['filas']:
+                nro_fila, h_anterior = indice['filas'][uuid]
+                if h_anterior is None:
+                    indice['filas'][uuid][1] = h
+                    sembrados += 1
+                elif h != h_anterior:
+                    actualizaciones.append({
+                        'range': f"{gspread.utils.rowcol_to_a1(nro_fila, 1)}:{gspread.utils.rowcol_to_a1(nro_fila, ultima_col)}",
+                        'values': [['' if v is None else v for v in valores]]
+                    })
+                    indice['filas'][uuid][1] = h
+                    escritos.add(uuid)
+            else:
+                nuevos.append((uuid, h, valores))
+
+        if actualizaciones:
+            sheet.batch_update(actualizaciones, value_input_option='USER_ENTERED')
+            total_actualizados += len(actualizaciones)
+
+        if nuevos:
+            respuesta = sheet.append_rows(values=[v for _, _, v in nuevos], value_input_option='USER_ENTERED')
+            fila_inicial = _fila_inicial(respuesta)
+            for i, (uuid, h, _) in enumerate(nuevos):
+                # Sin rango en la respuesta, la fila se recalcula en la próxima validación
+                indice['filas'][uuid] = [fila_inicial + i if fila_inicial else None, h]
+                escritos.add(uuid)
+            total_nuevos += len(nuevos)
+
+        total_sembrados += sembrados
+        if al_terminar_lote and (actualizaciones or nuevos or sembrados):
+            _vaciar_escrituras(sheet)
+            al_terminar_lote(indice)
+
+    _vaciar_escrituras(sheet)
+    if total_sembrados:
+        print(f"   🔨 {total_sembrados} filas ya en el sheet: se toma su hash de esta descarga sin reescribirlas")
+    print(f"   ✅ Sheet: {total_nuevos} filas nuevas, {total_actualizados} filas actualizadas")
+    return escritos
+
+
+# --- BIGQUERY ---
+
+def _leer_cola_bigquery():
+    if not os.path.exists(RUTA_COLA_BIGQUERY):
+        return None
+    cola = pd.read_pickle(RUTA_COLA_BIGQUERY)
+    if isinstance(cola, pd.DataFrame):  # Formato anterior, sin fecha
+        cola = {'desde': datetime.now(timezone.utc).isoformat(), 'filas': cola}
+    return cola
+
+
+def cargar_cola_bigquery():
+    """Filas ya cargadas en Sheets que todavía no llegaron a BigQuery (o None)."""
+    cola = _leer_cola_bigquery()
+    return cola['filas'] if cola else None
+
+
+def encolar_bigquery(df):
+    """
+    Agrega filas a la cola de BigQuery; por cada _uuid queda la versión más
+    reciente. Si lo pendiente de corridas anteriores tiene más de
+    KOBO_COLA_BIGQUERY_MAX_DIAS días o la cola pasaría de
+    KOBO_COLA_BIGQUERY_MAX_FILAS filas, se descarta lo anterior y queda sólo lo
+    de esta corrida (BigQuery se pone al día con backfill_historico.py
+    --destino bigquery).
+    """
+    ahora = datetime.now(timezone.utc)
+    cola = _leer_cola_bigquery()
+    desde = ahora.isoformat()
+    if cola is not None:
+        dias = (ahora - datetime.fromisoformat(cola['desde'])).total_seconds() / 86400
+        if dias > COLA_BIGQUERY_MAX_DIAS or len(cola['filas']) + len(df) > COLA_BIGQUERY_MAX_FILAS:
+            print(f"   ⚠️ Cola de BigQuery descartada ({len(cola['filas'])} filas pendientes hace {dias:.1f} días): "
+                  "reconstruir BigQuery con backfill_historico.py --destino bigquery")
+        else:
+            df = pd.concat([cola['filas'], df], ignore_index=True)
+            desde = cola['desde']
+    df = df.drop_duplicates(subset='_uuid', keep='last')
+    os.makedirs(ESTADO_DIR, exist_ok=True)
+    tmp = f"{RUTA_COLA_BIGQUERY}.{os.getpid()}.tmp"
+    pd.to_pickle({'desde': desde, 'filas': df}, tmp)
+    os.replace(tmp, RUTA_COLA_BIGQUERY)
+
+
+def vaciar_cola_bigquery():
+    if os.path.exists(RUTA_COLA_BIGQUERY):
+        os.remove(RUTA_COLA_BIGQUERY)
+
+
+def tabla_existe(client, tabla):
+    from google.api_core.exceptions import NotFound
+    try:
+        client.get_table(tabla)
+        return True
+    except NotFound:
+        return False
+
+
+def merge_bigquery(client, tabla_destino, tabla_staging, clave='uuid'):
+    """MERGE por clave desde la tabla staging; agrega columnas nuevas si hace falta."""
+    schema_destino = {f.name: f.field_type for f in client.get_table(tabla_destino).schema}
+    schema_staging = {f.name: f.field_type for f in client.get_table(tabla_staging).schema}
+
+    for col, tipo in schema_staging.items():
+        if col not in schema_destino:
+            tipo_sql = TIPOS_SQL.get(tipo, tipo)
+            client.query(f"ALTER TABLE `{tabla_destino}` ADD COLUMN IF NOT EXISTS `{col}` {tipo_sql}").result()
+            schema_destino[col] = tipo
+
+    def valor(col):
+        tipo_destino = TIPOS_SQL.get(schema_destino[col], schema_destino[col])
+        if schema_destino[col] == schema_staging[col]:
+            return f"S.`{col}`"
+        return f"SAFE_CAST(S.`{col}` AS {tipo_destino})"
+
+    columnas = list(schema_staging)
+    sql = f"""
+        MERGE `{tabla_destino}` T
+        USING `{tabla_staging}` S
+        ON CAST(T.`{clave}` AS STRING) = CAST(S.`{clave}` AS STRING)
+        WHEN MATCHED THEN UPDATE SET {', '.join(f'`{c}` = {valor(c)}' for c in columnas)}
+        WHEN NOT MATCHED THEN INSERT ({', '.join(f'`{c}`' for c in columnas)})
+        VALUES ({', '.join(valor(c) for c in columnas)})
+    """
+    resultado = client.query(sql).result()
+    client.delete_table(tabla_staging, not_found_ok=True)
+    return resultado